@@ -1,45 +1,175 @@
+import os
+import contextlib
+import collections
 import math
+import threading
 import torch
-import torch.utils.serialization
+import torch.utils.checkpoint
+from profiling import profiler
 
 arguments_strModel = 'sintel-final'
-SpyNet_model_dir = './models'  # SpyNet模型参数目录
+SpyNet_model_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models')  # SpyNet模型参数目录
 
-def normalize(tensorInput):
-    tensorRed = (tensorInput[:, 0:1, :, :] - 0.485) / 0.229
-    tensorGreen = (tensorInput[:, 1:2, :, :] - 0.456) / 0.224
-    tensorBlue = (tensorInput[:, 2:3, :, :] - 0.406) / 0.225
-    return torch.cat([tensorRed, tensorGreen, tensorBlue], 1)
+# SpyNet halves the frames 3 times, so frames of any other size are padded to a multiple of this.
+size_multiple = 32
+
+normalize_mean = [0.485, 0.456, 0.406]
+normalize_std = [0.229, 0.224, 0.225]
+
+def normalize(tensorInput, out=None):
+    """
+    :param tensorInput: [..., n_channels=3, h, w]
+    :param out: optional tensor of the same size to write the result into
+    """
+    tensorMean = tensorInput.new_tensor(normalize_mean).view(3, 1, 1)
+    tensorStd = tensorInput.new_tensor(normalize_std).view(3, 1, 1)
+    if out is None:
+        return (tensorInput - tensorMean) / tensorStd
+    return torch.sub(tensorInput, tensorMean, out=out).div_(tensorStd)
 
 
 def denormalize(tensorInput):
-    tensorRed = (tensorInput[:, 0:1, :, :] * 0.229) + 0.485
-    tensorGreen = (tensorInput[:, 1:2, :, :] * 0.224) + 0.456
-    tensorBlue = (tensorInput[:, 2:3, :, :] * 0.225) + 0.406
-    return torch.cat([tensorRed, tensorGreen, tensorBlue], 1)
+    tensorMean = tensorInput.new_tensor(normalize_mean).view(3, 1, 1)
+    tensorStd = tensorInput.new_tensor(normalize_std).view(3, 1, 1)
+    return tensorInput * tensorStd + tensorMean
 
 
-Backward_tensorGrid = {}
+def pad_to_multiple(frames, multiple=size_multiple):
+    """
+    :param frames: [..., n_channels=3, h, w]
+    :return: frames replicate-padded at the bottom and right so that h and w are multiples of multiple,
+             or frames itself if they already are
+    """
+    height, width = frames.size(-2), frames.size(-1)
+    pad_bottom = -height % multiple
+    pad_right = -width % multiple
+    if pad_bottom == 0 and pad_right == 0:
+        return frames
+    padded = torch.nn.functional.pad(frames.reshape(-1, frames.size(-3), height, width),
+                                     pad=[0, pad_right, 0, pad_bottom], mode='replicate')
+    return padded.view(*frames.shape[:-2], height + pad_bottom, width + pad_right)
 
-def Backward(tensorInput, tensorFlow, cuda_flag):
-    if str(tensorFlow.size()) not in Backward_tensorGrid:
-        tensorHorizontal = torch.linspace(-1.0, 1.0, tensorFlow.size(3)).view(1, 1, 1, tensorFlow.size(3)).expand(tensorFlow.size(0), -1, tensorFlow.size(2), -1)
-        tensorVertical = torch.linspace(-1.0, 1.0, tensorFlow.size(2)).view(1, 1, tensorFlow.size(2), 1).expand(tensorFlow.size(0), -1, -1, tensorFlow.size(3))
-        if cuda_flag:
-            Backward_tensorGrid[str(tensorFlow.size())] = torch.cat([ tensorHorizontal, tensorVertical ], 1).cuda()
+
+class Workspace(object):
+    """
+    Buffers reused across calls of TOFlow.inference.
+    A buffer is reallocated only when the requested size, device or dtype changes.
+    """
+    def __init__(self):
+        self.buffers = {}
+
+    def get(self, name, size, like):
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.size() != size or buffer.device != like.device or buffer.dtype != like.dtype:
+            buffer = like.new_empty(size)
+            self.buffers[name] = buffer
+        return buffer
+
+    def clear(self):
+        self.buffers.clear()
+
+
+class GridCache(object):
+    """
+    LRU cache of the sampling grids shared by Backward and warp.
+    Grids are keyed on (kind, height, width, device, dtype) and stored with batch size 1,
+    so they broadcast over any batch size. Least recently used grids are evicted
+    once the cached grids take more than max_bytes. Safe to share between threads,
+    like the batching threads of server.py.
+    """
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        # reentrant, get holds it while it evicts
+        self.lock = threading.RLock()
+        self.grids = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, kind, height, width, device, dtype):
+        """
+        :param kind: 'normalized' for the [-1, 1] grid of Backward, 'pixel' for the pixel coordinates of warp
+        :return: grid: [1, 2, height, width]
+        """
+        key = (kind, height, width, str(device), dtype)
+        with self.lock:
+            if key in self.grids:
+                self.hits += 1
+                self.grids.move_to_end(key)
+                return self.grids[key]
+
+            self.misses += 1
+            grid = self.build(kind, height, width, device, dtype)
+            self.grids[key] = grid
+            self.nbytes += grid.numel() * grid.element_size()
+            self.evict()
+            return grid
+
+    @staticmethod
+    def build(kind, height, width, device, dtype):
+        if kind == 'normalized':
+            tensorHorizontal = torch.linspace(-1.0, 1.0, width, device=device, dtype=dtype).view(1, 1, 1, width).expand(1, -1, height, -1)
+            tensorVertical = torch.linspace(-1.0, 1.0, height, device=device, dtype=dtype).view(1, 1, height, 1).expand(1, -1, -1, width)
+        elif kind == 'pixel':
+            tensorHorizontal = torch.arange(width, device=device, dtype=dtype).view(1, 1, 1, width).expand(1, -1, height, -1)
+            tensorVertical = torch.arange(height, device=device, dtype=dtype).view(1, 1, height, 1).expand(1, -1, -1, width)
         else:
-            Backward_tensorGrid[str(tensorFlow.size())] = torch.cat([tensorHorizontal, tensorVertical], 1)
-    # end
+            raise NameError('Only support: [normalized, pixel] grids')
+        return torch.cat([tensorHorizontal, tensorVertical], 1)
+
+    def evict(self):
+        # always keep the grid that was just built, even if it alone exceeds max_bytes.
+        with self.lock:
+            while self.nbytes > self.max_bytes and len(self.grids) > 1:
+                _, grid = self.grids.popitem(last=False)
+                self.nbytes -= grid.numel() * grid.element_size()
+
+    def set_max_bytes(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self.evict()
+
+    def clear(self):
+        with self.lock:
+            self.grids.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.grids),
+                    'nbytes': self.nbytes, 'max_bytes': self.max_bytes}
+
+
+grid_cache = GridCache()
+
+def Backward(tensorInput, tensorFlow, cuda_flag):
+    # the grid follows the device and dtype of tensorFlow, cuda_flag is kept for compatibility.
+    tensorGrid = grid_cache.get('normalized', tensorFlow.size(2), tensorFlow.size(3), tensorFlow.device, tensorFlow.dtype)
 
     tensorFlow = torch.cat([ tensorFlow[:, 0:1, :, :] / ((tensorInput.size(3) - 1.0) / 2.0), tensorFlow[:, 1:2, :, :] / ((tensorInput.size(2) - 1.0) / 2.0) ], 1)
 
-    return torch.nn.functional.grid_sample(input=tensorInput, grid=(Backward_tensorGrid[str(tensorFlow.size())] + tensorFlow).permute(0, 2, 3, 1), mode='bilinear', padding_mode='border')
+    return torch.nn.functional.grid_sample(input=tensorInput, grid=(tensorGrid + tensorFlow).permute(0, 2, 3, 1), mode='bilinear', padding_mode='border', align_corners=True)
 # end
 
+precisions = ['fp32', 'bf16']
+
+def reduced_precision(precision, tensor):
+    """
+    the context to run the convolutions in: autocast to bfloat16 for 'bf16', nothing for 'fp32'.
+    the flows, the sampling grids and grid_sample are kept in float32 by the callers.
+    """
+    if precision == 'bf16':
+        return torch.autocast(device_type=tensor.device.type, dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+spynet_level_names = ['SpyNet.level%d' % intLevel for intLevel in range(4)]
+
 class SpyNet(torch.nn.Module):
-    def __init__(self, cuda_flag):
+    def __init__(self, cuda_flag, pretrained=True):
         super(SpyNet, self).__init__()
         self.cuda_flag = cuda_flag
+        self.precision = 'fp32'
 
         class Basic(torch.nn.Module):
             def __init__(self, intLevel):
@@ -64,7 +194,9 @@ class SpyNet(torch.nn.Module):
 
         self.moduleBasic = torch.nn.ModuleList([Basic(intLevel) for intLevel in range(4)])
 
-        self.load_state_dict(torch.load(SpyNet_model_dir + '/network-' + arguments_strModel + '.pytorch'), strict=False)
+        # pretrained=False leaves the weights random, e.g. when they are overwritten by a TOFlow state dict.
+        if pretrained:
+            self.load_state_dict(torch.load(SpyNet_model_dir + '/network-' + arguments_strModel + '.pytorch'), strict=False)
 
 
     def forward(self, tensorFirst, tensorSecond):
@@ -93,11 +225,17 @@ class SpyNet(torch.nn.Module):
             # 		   the output of w with input second picture of corresponding level and upsampling flow,
             # 		   upsampling flow]
             # then we obtain the final flow. 最终再加起来得到intLevel的flow
-            tensorFlow = self.moduleBasic[intLevel](torch.cat([tensorFirst[intLevel],
-                                                               Backward(tensorInput=tensorSecond[intLevel],
-                                                                        tensorFlow=tensorUpsampled,
-                                                                        cuda_flag=self.cuda_flag),
-                                                               tensorUpsampled], 1)) + tensorUpsampled
+            with profiler.span(spynet_level_names[intLevel]) as span:
+                tensorInput = torch.cat([tensorFirst[intLevel],
+                                         Backward(tensorInput=tensorSecond[intLevel],
+                                                  tensorFlow=tensorUpsampled,
+                                                  cuda_flag=self.cuda_flag),
+                                         tensorUpsampled], 1)
+                with reduced_precision(self.precision, tensorInput):
+                    tensorResidual = self.moduleBasic[intLevel](tensorInput)
+                # the flow is accumulated in the precision of the input
+                tensorFlow = tensorResidual.to(tensorUpsampled.dtype) + tensorUpsampled
+                span.set_output(tensorFlow)
         return tensorFlow
 
 
@@ -106,39 +244,24 @@ class warp(torch.nn.Module):
         super(warp, self).__init__()
         self.height = h
         self.width = w
-        if cuda_flag:
-            self.addterm = self.init_addterm().cuda()
-        else:
-            self.addterm = self.init_addterm()
-
-    def init_addterm(self):
-        n = torch.FloatTensor(list(range(self.width)))
-        horizontal_term = n.expand((1, 1, self.height, self.width))  # 第一个1是batch size
-        n = torch.FloatTensor(list(range(self.height)))
-        vertical_term = n.expand((1, 1, self.width, self.height)).permute(0, 1, 3, 2)
-        addterm = torch.cat((horizontal_term, vertical_term), dim=1)
-        return addterm
+        self.cuda_flag = cuda_flag
 
+    @profiler.traced('warp')
     def forward(self, frame, flow):
         """
-        :param frame: frame.shape (batch_size=1, n_channels=3, width=256, height=448)
-        :param flow: flow.shape (batch_size=1, n_channels=2, width=256, height=448)
+        :param frame: frame.shape (batch_size, n_channels=3, height, width)
+        :param flow: flow.shape (batch_size, n_channels=2, height, width)
         :return: reference_frame: warped frame
         """
-        if True:
-            flow = flow + self.addterm
-        else:
-            self.addterm = self.init_addterm()
-            flow = flow + self.addterm
-
-        horizontal_flow = flow[0, 0, :, :].expand(1, 1, self.height, self.width)  # 第一个0是batch size
-        vertical_flow = flow[0, 1, :, :].expand(1, 1, self.height, self.width)
+        height, width = flow.size(2), flow.size(3)
+        # addterm的batch size是1, 广播到整个batch
+        flow = flow + grid_cache.get('pixel', height, width, flow.device, flow.dtype)
 
-        horizontal_flow = horizontal_flow * 2 / (self.width - 1) - 1
-        vertical_flow = vertical_flow * 2 / (self.height - 1) - 1
+        horizontal_flow = flow[:, 0:1, :, :] * 2 / (width - 1) - 1
+        vertical_flow = flow[:, 1:2, :, :] * 2 / (height - 1) - 1
         flow = torch.cat((horizontal_flow, vertical_flow), dim=1)
         flow = flow.permute(0, 2, 3, 1)
-        reference_frame = torch.nn.functional.grid_sample(frame, flow)
+        reference_frame = torch.nn.functional.grid_sample(frame, flow, align_corners=True)
         return reference_frame
 
 
@@ -150,12 +273,15 @@ class ResNet(torch.nn.Module):
     def __init__(self, task):
         super(ResNet, self).__init__()
         self.task = task
+        self.precision = 'fp32'
+        self.checkpointing = False
         self.conv_3x2_64_9x9 = torch.nn.Conv2d(in_channels=3 * 2, out_channels=64, kernel_size=9, padding=8 // 2)
         self.conv_3x7_64_9x9 = torch.nn.Conv2d(in_channels=3 * 7, out_channels=64, kernel_size=9, padding=8 // 2)
         self.conv_64_64_9x9 = torch.nn.Conv2d(in_channels=64, out_channels=64, kernel_size=9, padding=8 // 2)
         self.conv_64_64_1x1 = torch.nn.Conv2d(in_channels=64, out_channels=64, kernel_size=1)
         self.conv_64_3_1x1 = torch.nn.Conv2d(in_channels=64, out_channels=3, kernel_size=1)
 
+    @profiler.traced('ResNet.ResBlock')
     def ResBlock(self, x, aver):
         if self.task == 'interp':
             x = torch.nn.functional.relu(self.conv_3x2_64_9x9(x))
@@ -174,22 +300,30 @@ class ResNet(torch.nn.Module):
 
     def forward(self, frames):
         aver = frames.mean(dim=1)
-        x = frames[:, 0, :, :, :]
-        for i in range(1, frames.size(1)):
-            x = torch.cat((x, frames[:, i, :, :, :]), dim=1)
-        result = self.ResBlock(x, aver)
+        # [batch_size, img_num, 3, h, w] -> [batch_size, img_num * 3, h, w], a view of frames
+        x = frames.reshape(frames.size(0), frames.size(1) * frames.size(2), frames.size(3), frames.size(4))
+        with reduced_precision(self.precision, x):
+            if self.checkpointing and torch.is_grad_enabled():
+                # keep only x and aver for backward, the block is run again to get its activations
+                result = torch.utils.checkpoint.checkpoint(self.ResBlock, x, aver, use_reentrant=False)
+            else:
+                result = self.ResBlock(x, aver)
+        result = result.to(frames.dtype)
         return result
 
 
 class TOFlow(torch.nn.Module):
-    def __init__(self, h, w, task, cuda_flag):
+    def __init__(self, h, w, task, cuda_flag, pretrained=True):
+        """
+        :param h, w: the nominal frame size, recorded in model packages. frames of any size are accepted.
+        """
         super(TOFlow, self).__init__()
         self.height = h
         self.width = w
         self.task = task
         self.cuda_flag = cuda_flag
 
-        self.SpyNet = SpyNet(cuda_flag=self.cuda_flag)  # SpyNet层
+        self.SpyNet = SpyNet(cuda_flag=self.cuda_flag, pretrained=pretrained)  # SpyNet层
         # for param in self.SpyNet.parameters():  # fix
         #     param.requires_grad = False
 
@@ -197,42 +331,165 @@ class TOFlow(torch.nn.Module):
 
         self.ResNet = ResNet(task=self.task)
 
-    # frames should be TensorFloat
-    def forward(self, frames):
+        self.workspace = Workspace()
+        self.precision = 'fp32'
+        self.checkpointing = False
+
+    def batched_flow(self, frames, first_index, second_index):
         """
-        :param frames: [batch_size=1, img_num, n_channels=3, h, w]
-        :return:
+        Estimate the flows of several (first, second) frame pairs with one SpyNet call.
+        :param frames: [batch_size, img_num, n_channels=3, h, w]
+        :param first_index: frame index of the first frame of each pair
+        :param second_index: frame index of the second frame of each pair
+        :return: flows: [batch_size, len(first_index), 2, h, w]
         """
-        for i in range(frames.size(1)):
-            frames[:, i, :, :, :] = normalize(frames[:, i, :, :, :])
-
-        if self.cuda_flag:
-            opticalflows = torch.zeros(frames.size(0), frames.size(1), 2, frames.size(3), frames.size(4)).cuda()
-            warpframes = torch.empty(frames.size(0), frames.size(1), 3, frames.size(3), frames.size(4)).cuda()
+        batch_size, pair_num = frames.size(0), len(first_index)
+        # stack every pair along the batch dimension, so SpyNet runs its pyramid only once.
+        tensorFirst = frames[:, first_index, :, :, :].reshape(batch_size * pair_num, frames.size(2), frames.size(3), frames.size(4))
+        tensorSecond = frames[:, second_index, :, :, :].reshape(batch_size * pair_num, frames.size(2), frames.size(3), frames.size(4))
+        if self.checkpointing and torch.is_grad_enabled():
+            # one checkpointed SpyNet call per pair: backward recomputes the pyramid of a single pair
+            # at a time instead of keeping the activations of every pair from the forward pass.
+            tensorFirst = tensorFirst.view(batch_size, pair_num, *tensorFirst.shape[1:])
+            tensorSecond = tensorSecond.view(batch_size, pair_num, *tensorSecond.shape[1:])
+            flows = torch.stack([torch.utils.checkpoint.checkpoint(self.SpyNet, tensorFirst[:, k], tensorSecond[:, k], use_reentrant=False)
+                                 for k in range(pair_num)], 1)
         else:
-            opticalflows = torch.zeros(frames.size(0), frames.size(1), 2, frames.size(3), frames.size(4))
-            warpframes = torch.empty(frames.size(0), frames.size(1), 3, frames.size(3), frames.size(4))
+            flows = self.SpyNet(tensorFirst, tensorSecond)
+        return flows.view(batch_size, pair_num, 2, frames.size(3), frames.size(4))
 
+    def flow_pairs(self):
+        """
+        :return: process_index, reference_index, scale: the k-th flow is the SpyNet flow of
+                 (reference_index[k], process_index[k]) times scale, and warps frame process_index[k] to the reference.
+        """
         if self.task == 'interp':
-            process_index = [0, 1]
-            opticalflows[:, 1, :, :, :] = self.SpyNet(frames[:, 0, :, :, :], frames[:, 1, :, :, :]) / 2
-            opticalflows[:, 0, :, :, :] = self.SpyNet(frames[:, 1, :, :, :], frames[:, 0, :, :, :]) / 2
+            return [0, 1], [1, 0], 0.5
         elif self.task in ['denoise', 'denoising', 'sr', 'super-resolution']:
-            process_index = [0, 1, 2, 4, 5, 6]
-            for i in process_index:
-                opticalflows[:, i, :, :, :] = self.SpyNet(frames[:, 3, :, :, :], frames[:, i, :, :, :])
-            warpframes[:, 3, :, :, :] = frames[:, 3, :, :, :]
+            return [0, 1, 2, 4, 5, 6], [3] * 6, 1.0
+        raise NameError('Only support: [interp, denoise/denoising, sr/super-resolution]')
+
+    def estimate_flows(self, frames):
+        """
+        The flows forward warps the frames with, without autograd, e.g. to cache them while SpyNet is frozen.
+        :param frames: [batch_size, img_num, n_channels=3, h, w]
+        :return: flows: [batch_size, len(process_index), 2, padded_h, padded_w], of the frames padded by pad_to_multiple
+        """
+        process_index, reference_index, scale = self.flow_pairs()
+        with torch.no_grad():
+            return self.batched_flow(normalize(pad_to_multiple(frames)), reference_index, process_index) * scale
 
+    # frames should be TensorFloat
+    @profiler.traced('TOFlow.forward')
+    def forward(self, frames, workspace=None, flows=None):
+        """
+        :param frames: [batch_size, img_num, n_channels=3, h, w] of any h and w, left unchanged
+        :param workspace: Workspace holding the intermediate buffers, see inference
+        :param flows: the flows of estimate_flows for frames, or their top left h x w crop, so that SpyNet is not run.
+                      default: estimate them
+        :return: Img: [batch_size, n_channels=3, h, w]
+        """
+        batch_size, height, width = frames.size(0), frames.size(3), frames.size(4)
+        # pad rather than resize, the padding is cropped from the output
+        frames = pad_to_multiple(frames)
+        padded_height, padded_width = frames.size(3), frames.size(4)
+        if workspace is None:
+            frames = normalize(frames)
         else:
-            raise NameError('Only support: [interp, denoise/denoising, sr/super-resolution]')
+            frames = normalize(frames, out=workspace.get('frames', frames.size(), frames))
+
+        # the k-th flow warps frame process_index[k] to the reference.
+        process_index, reference_index, scale = self.flow_pairs()
+        if flows is None:
+            opticalflows = self.batched_flow(frames, reference_index, process_index)
+            if scale != 1.0:
+                opticalflows = opticalflows * scale
+        else:
+            opticalflows = pad_to_multiple(flows.to(frames.dtype))
 
-        for i in process_index:
-            warpframes[:, i, :, :, :] = self.warp(frames[:, i, :, :, :], opticalflows[:, i, :, :, :])
-        # warpframes: [batch_size=1, img_num=7, n_channels=3, height=256, width=448]
+        # warp every neighbor frame of every sample with one batched call.
+        process_num = len(process_index)
+        warped = self.warp(frames[:, process_index, :, :, :].reshape(batch_size * process_num, 3, padded_height, padded_width),
+                           opticalflows.view(batch_size * process_num, 2, padded_height, padded_width))
+        warped = warped.view(batch_size, process_num, 3, padded_height, padded_width)
+
+        if self.task == 'interp':
+            warpframes = warped
+        else:
+            if workspace is None:
+                warpframes = frames.new_empty(frames.size())
+            else:
+                warpframes = workspace.get('warpframes', frames.size(), frames)
+            warpframes[:, process_index, :, :, :] = warped
+            warpframes[:, 3, :, :, :] = frames[:, 3, :, :, :]
+        # warpframes: [batch_size, img_num=7, n_channels=3, padded_height, padded_width]
 
         Img = self.ResNet(warpframes)
-        # Img: [batch_size=1, n_channels=3, h, w]
+        # Img: [batch_size, n_channels=3, h, w]
 
-        Img = denormalize(Img)
+        Img = denormalize(Img[:, :, :height, :width])
 
         return Img
+
+    @profiler.traced('TOFlow.interpolate')
+    def interpolate(self, frame0, frame1, timesteps):
+        """
+        Synthesize the frames at several times between frame0 and frame1 with the interp model.
+        The two flows are estimated once and scaled for every t: frame0 is warped by t times the flow
+        from frame1 to frame0 and frame1 by 1 - t times the flow from frame0 to frame1, then warp and
+        ResNet run on all the timesteps as one batch. t = 0.5 gives the output of forward.
+        :param frame0, frame1: [batch_size, n_channels=3, h, w] of any h and w
+        :param timesteps: the times t in (0, 1) to synthesize, 0 being frame0 and 1 frame1
+        :return: Img: [batch_size, len(timesteps), n_channels=3, h, w]
+        """
+        if self.task != 'interp':
+            raise NameError('Only the interp model interpolates, this is a [%s] model.' % self.task)
+        batch_size, height, width = frame0.size(0), frame0.size(2), frame0.size(3)
+        step_num = len(timesteps)
+        frames = normalize(pad_to_multiple(torch.stack([frame0, frame1], 1)))
+        padded_height, padded_width = frames.size(3), frames.size(4)
+
+        # flows[:, 0] warps frame0 to frame1, flows[:, 1] frame1 to frame0
+        flows = self.batched_flow(frames, [1, 0], [0, 1])
+        times = frames.new_tensor(timesteps).view(1, step_num, 1, 1, 1)
+        # [batch_size, step_num, 2 frames, 2, padded_height, padded_width]
+        opticalflows = torch.stack([flows[:, 0:1] * times, flows[:, 1:2] * (1 - times)], 2)
+        neighbors = frames.unsqueeze(1).expand(-1, step_num, -1, -1, -1, -1)
+
+        warped = self.warp(neighbors.reshape(batch_size * step_num * 2, 3, padded_height, padded_width),
+                           opticalflows.reshape(batch_size * step_num * 2, 2, padded_height, padded_width))
+        Img = self.ResNet(warped.view(batch_size * step_num, 2, 3, padded_height, padded_width))
+        Img = denormalize(Img[:, :, :height, :width])
+        return Img.view(batch_size, step_num, 3, height, width)
+
+    def set_precision(self, precision):
+        """
+        :param precision: 'fp32', or 'bf16' to run the SpyNet and ResNet convolutions in bfloat16
+        """
+        if precision not in precisions:
+            raise NameError('Only support: [%s] precisions' % ', '.join(precisions))
+        self.precision = precision
+        self.SpyNet.precision = precision
+        self.ResNet.precision = precision
+        return self
+
+    def set_checkpointing(self, enabled):
+        """
+        :param enabled: recompute the activations of every SpyNet flow pair and of the ResNet block during backward
+                        instead of keeping them from the forward pass. trades compute for training memory,
+                        inference and torch.no_grad() are not affected.
+        """
+        self.checkpointing = enabled
+        self.ResNet.checkpointing = enabled
+        return self
+
+    def inference(self, frames):
+        """
+        Inference without autograd. The intermediate tensors are kept in self.workspace
+        and reused by the next call with the same input size, which suits streaming
+        frames of a fixed resolution.
+        :param frames: [batch_size, img_num, n_channels=3, h, w], left unchanged
+        :return: Img: [batch_size, n_channels=3, h, w]
+        """
+        with torch.no_grad():
+            return self(frames, workspace=self.workspace)
@@ -0,0 +1,225 @@
+import os
+import sys
+import json
+import time
+import getopt
+import shutil
+import platform
+import tempfile
+import statistics
+import numpy as np
+import torch
+import matplotlib.pyplot as plt
+import PIL.Image
+from Network import TOFlow, SpyNet, ResNet, Backward, warp, normalize, denormalize
+from read_data import MemoryFriendlyLoader
+
+plt.switch_backend('agg')
+
+stages = ['spynet_level', 'spynet', 'backward', 'warp', 'resnet', 'normalize', 'denormalize', 'toflow', 'loader_decode', 'png_write']
+tasks = ['interp', 'denoise', 'sr']
+
+
+def measure(function, warmup=2, repeat=10):
+    """:return: the seconds of every timed call"""
+    for _ in range(warmup):
+        function()
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+def spynet_level_sizes(height, width):
+    """the (height, width) of the SpyNet pyramid levels, from the coarsest to the finest"""
+    sizes = [(height, width)]
+    for intLevel in range(3):
+        if sizes[0][0] > 32 or sizes[0][1] > 32:
+            sizes.insert(0, (sizes[0][0] // 2, sizes[0][1] // 2))
+    return sizes
+
+
+def write_synthetic_septuplet(directory, height, width):
+    """write a synthetic denoising sample, 7 noisy frames and the ground truth, for MemoryFriendlyLoader"""
+    rng = np.random.RandomState(0)
+    for subdir in ['origin', 'edited']:
+        os.makedirs(os.path.join(directory, subdir, '00001', '0001'))
+    for i in range(7):
+        PIL.Image.fromarray(rng.randint(0, 256, (height, width, 3), dtype=np.uint8)).save(
+            os.path.join(directory, 'edited', '00001', '0001', 'im%04d.png' % (i + 1)))
+    PIL.Image.fromarray(rng.randint(0, 256, (height, width, 3), dtype=np.uint8)).save(
+        os.path.join(directory, 'origin', '00001', '0001', 'im4.png'))
+    with open(os.path.join(directory, 'pathlist.txt'), 'w') as fp:
+        fp.write('00001/0001')
+    return MemoryFriendlyLoader(origin_img_dir=os.path.join(directory, 'origin'),
+                                edited_img_dir=os.path.join(directory, 'edited'),
+                                pathlistfile=os.path.join(directory, 'pathlist.txt'), task='denoise')
+
+
+def benchmark_size(height, width, batch_size, selected, warmup, repeat):
+    """
+    Time every selected stage on synthetic inputs of one resolution and batch size.
+    batch_size counts frame pairs for spynet/backward/warp, frames for normalize/denormalize/png_write
+    and samples for resnet/toflow.
+    """
+    results = []
+
+    def record(stage, function, **extra):
+        seconds = measure(function, warmup, repeat)
+        result = {'stage': stage, 'height': height, 'width': width, 'batch': batch_size,
+                  'median_ms': statistics.median(seconds) * 1000, 'mean_ms': statistics.mean(seconds) * 1000,
+                  'min_ms': min(seconds) * 1000, 'repeat': repeat}
+        result.update(extra)
+        results.append(result)
+        print('%-14s %-10s %5dx%-5d batch %2d  median %9.2f ms  min %9.2f ms' %
+              (stage, extra.get('variant', ''), height, width, batch_size, result['median_ms'], result['min_ms']))
+
+    frames = torch.rand(batch_size, 3, height, width)
+    flow = torch.randn(batch_size, 2, height, width)
+
+    if 'spynet_level' in selected or 'spynet' in selected:
+        spynet = SpyNet(cuda_flag=False, pretrained=False).eval()
+        if 'spynet_level' in selected:
+            for intLevel, (level_height, level_width) in enumerate(spynet_level_sizes(height, width)):
+                level_input = torch.randn(batch_size, 8, level_height, level_width)
+                record('spynet_level', lambda: spynet.moduleBasic[intLevel](level_input), variant='level%d' % intLevel)
+        if 'spynet' in selected:
+            second = torch.rand(batch_size, 3, height, width)
+            record('spynet', lambda: spynet(frames, second))
+    if 'backward' in selected:
+        record('backward', lambda: Backward(frames, flow, cuda_flag=False))
+    if 'warp' in selected:
+        warp_module = warp(height, width, cuda_flag=False)
+        record('warp', lambda: warp_module(frames, flow))
+    if 'resnet' in selected:
+        for task in tasks:
+            resnet = ResNet(task).eval()
+            warpframes = torch.rand(batch_size, 2 if task == 'interp' else 7, 3, height, width)
+            record('resnet', lambda: resnet(warpframes), variant=task)
+    if 'normalize' in selected:
+        record('normalize', lambda: normalize(frames))
+    if 'denormalize' in selected:
+        record('denormalize', lambda: denormalize(frames))
+    if 'toflow' in selected:
+        for task in tasks:
+            net = TOFlow(height, width, task=task, cuda_flag=False, pretrained=False).eval()
+            inputs = torch.rand(batch_size, 2 if task == 'interp' else 7, 3, height, width)
+            record('toflow', lambda: net.inference(inputs), variant=task)
+    if batch_size == 1 and ('loader_decode' in selected or 'png_write' in selected):
+        directory = tempfile.mkdtemp(prefix='pytoflow_benchmark_')
+        try:
+            if 'loader_decode' in selected:
+                dataset = write_synthetic_septuplet(directory, height, width)
+                record('loader_decode', lambda: dataset[0])
+            if 'png_write' in selected:
+                image = np.random.rand(height, width, 3).astype(np.float32)
+                record('png_write', lambda: plt.imsave(os.path.join(directory, 'out.png'), image))
+        finally:
+            shutil.rmtree(directory)
+    return results
+
+
+def run_benchmarks(sizes, batch_sizes, selected, warmup=2, repeat=10, threads=1, seed=0):
+    torch.manual_seed(seed)
+    torch.set_num_threads(threads)
+    results = []
+    with torch.no_grad():
+        for height, width in sizes:
+            for batch_size in batch_sizes:
+                results += benchmark_size(height, width, batch_size, selected, warmup, repeat)
+    return {'meta': {'torch': torch.__version__, 'python': platform.python_version(), 'machine': platform.machine(),
+                     'processor': platform.processor(), 'threads': threads, 'warmup': warmup, 'repeat': repeat},
+            'results': results}
+
+
+def result_key(result):
+    return result['stage'], result.get('variant', ''), result['height'], result['width'], result['batch']
+
+
+def compare(report, baseline, tolerance):
+    """
+    :return: the results whose median is more than tolerance slower than the baseline
+    """
+    baseline_results = dict((result_key(result), result) for result in baseline['results'])
+    regressions = []
+    for result in report['results']:
+        base = baseline_results.get(result_key(result))
+        if base is None:
+            continue
+        ratio = result['median_ms'] / base['median_ms']
+        flag = 'REGRESSION' if ratio > 1 + tolerance else ''
+        print('%-14s %-10s %5dx%-5d batch %2d  %9.2f ms -> %9.2f ms  x%.2f %s' %
+              (result['stage'], result.get('variant', ''), result['height'], result['width'], result['batch'],
+               base['median_ms'], result['median_ms'], ratio, flag))
+        if flag:
+            regressions.append(result)
+    return regressions
+
+
+if __name__ == '__main__':
+    sizes = [(64, 112), (128, 224), (256, 448)]
+    batch_sizes = [1, 4]
+    selected = list(stages)
+    warmup = 2
+    repeat = 10
+    threads = 1
+    out_file = 'benchmark.json'
+    baseline_file = ''
+    tolerance = 0.2
+
+    if len(sys.argv) > 1 and sys.argv[1] in ['-h', '--help']:
+        print("""pytoflow version 1.1
+usage: python3 benchmark.py [[option] [value]]...
+options:
+--sizes        the resolutions to benchmark. default: 64x112,128x224,256x448
+--batchSizes   the batch sizes to benchmark. default: 1,4
+--stages       the stages to benchmark. default: all of
+               %s
+--warmup       untimed calls before timing. default: 2
+--repeat       timed calls per stage. default: 10
+--threads      the number of intra-op threads. default: 1
+--out          the JSON file to write the results to. default: benchmark.json
+--baseline     a previous result file. exits with 1 if a stage got slower than --tolerance.
+--tolerance    allowed slowdown against the baseline. default: 0.2
+-h, --help     get help.""" % ','.join(stages))
+        exit(0)
+
+    for strOption, strArgument in getopt.getopt(sys.argv[1:], '', [strParameter[2:] + '=' for strParameter in sys.argv[1::2]])[0]:
+        if strOption == '--sizes':
+            sizes = [tuple(int(x) for x in size.split('x')) for size in strArgument.split(',')]
+        elif strOption == '--batchSizes':
+            batch_sizes = [int(x) for x in strArgument.split(',')]
+        elif strOption == '--stages':
+            selected = strArgument.split(',')
+        elif strOption == '--warmup':
+            warmup = int(strArgument)
+        elif strOption == '--repeat':
+            repeat = int(strArgument)
+        elif strOption == '--threads':
+            threads = int(strArgument)
+        elif strOption == '--out':
+            out_file = strArgument
+        elif strOption == '--baseline':
+            baseline_file = strArgument
+        elif strOption == '--tolerance':
+            tolerance = float(strArgument)
+
+    for stage in selected:
+        if stage not in stages:
+            raise ValueError('Invalid [--stages].\nOnly support: [%s]' % ', '.join(stages))
+
+    report = run_benchmarks(sizes, batch_sizes, selected, warmup=warmup, repeat=repeat, threads=threads)
+    with open(out_file, 'w') as fp:
+        json.dump(report, fp, indent=2)
+    print('Results saved to %s.' % out_file)
+
+    if baseline_file:
+        with open(baseline_file) as fp:
+            baseline = json.load(fp)
+        regressions = compare(report, baseline, tolerance)
+        if regressions:
+            print('%d stages are more than %d%% slower than %s.' % (len(regressions), tolerance * 100, baseline_file))
+            sys.exit(1)
+        print('No regression against %s.' % baseline_file)
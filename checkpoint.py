@@ -0,0 +1,118 @@
+import os
+import re
+import queue
+import random
+import threading
+import numpy as np
+import torch
+
+
+def snapshot(state):
+    """
+    :param state: nested dicts and lists of tensors and other values, like a state dict
+    :return: a copy of state with every tensor copied to host memory, unaffected by later training steps
+    """
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return type(state)((key, snapshot(value)) for key, value in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value) for value in state)
+    return state
+
+
+def rng_state():
+    """the states of the random generators of python, numpy, torch and CUDA"""
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def atomic_save(obj, path):
+    """torch.save to a temporary file next to path and rename it, so that path is either the old or the new file"""
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'wb') as fp:
+        torch.save(obj, fp)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(temporary_path, path)
+
+
+def step_checkpoints(directory):
+    """:return: [(step, path)] of the checkpoint_%dstep.ckpt files in directory, the latest last"""
+    if not os.path.isdir(directory):
+        return []
+    found = []
+    for name in os.listdir(directory):
+        match = re.match(r'checkpoint_(\d+)step\.ckpt$', name)
+        if match:
+            found.append((int(match.group(1)), os.path.join(directory, name)))
+    return sorted(found)
+
+
+def latest_checkpoint(directory):
+    """:return: the path of the checkpoint written last in directory, or None"""
+    paths = [os.path.join(directory, name) for name in os.listdir(directory) if name.endswith('.ckpt')] \
+        if os.path.isdir(directory) else []
+    return max(paths, key=os.path.getmtime) if paths else None
+
+
+class AsyncCheckpointer(object):
+    """
+    Write checkpoints on a background thread. save() only snapshots the state to host memory,
+    so training goes on while the previous checkpoint is written, and waits only if the writer is
+    still busy with an older one. Every file is written with atomic_save.
+    """
+    def __init__(self, directory, keep=2):
+        """:param keep: the number of checkpoint_%dstep.ckpt files kept, older ones are deleted"""
+        self.directory = directory
+        self.keep = keep
+        self.error = None
+        self.queue = queue.Queue(maxsize=1)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.thread = threading.Thread(target=self.run, name='checkpoint-writer', daemon=True)
+        self.thread.start()
+
+    def save(self, state, name):
+        """:param name: the file name in self.directory"""
+        self.raise_error()
+        self.queue.put((snapshot(state), os.path.join(self.directory, name)))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            state, path = item
+            try:
+                atomic_save(state, path)
+                for _, old_path in step_checkpoints(self.directory)[:-self.keep]:
+                    os.remove(old_path)
+            except Exception as error:
+                self.error = error
+            self.queue.task_done()
+
+    def raise_error(self):
+        if self.error is not None:
+            raise RuntimeError('Writing a checkpoint failed: %s' % self.error)
+
+    def wait(self):
+        """block until every checkpoint given to save is on disk"""
+        self.queue.join()
+        self.raise_error()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.raise_error()
@@ -1,12 +1,22 @@
 import torch
+import torch.multiprocessing
 import numpy as np
 import sys
+import json
 import getopt
 import os
 import shutil
 import matplotlib.pyplot as plt
 import datetime
-from Network import TOFlow
+import collections
+import time
+import queue
+import threading
+import concurrent.futures
+from model_package import load_model, build_toflow
+from metrics import MetricLog
+from read_data import get_process_index, read_sequence, read_ground_truth
+from profiling import profiler
 import warnings
 warnings.filterwarnings("ignore", module="matplotlib.pyplot")
 # ------------------------------
@@ -18,6 +28,16 @@ dataset_dir = ''
 pathlistfile = ''
 model_path = ''
 gpuID = None
+batch_size = 1
+pipeline = False
+readers = 4
+writers = 4
+queue_depth = 4
+gt_dir = ''
+profile_path = ''
+precision = ''
+workers = 1
+threads = None
 
 if sys.argv[1] in ['-h', '--help']:
     print("""pytoflow version 1.0
@@ -27,8 +47,19 @@ options:
                valid values:[interp, denoise, denoising, sr, super-resolution]
 --dataDir      the directory of the input image dataset(Vimeo-90K, Vimeo-90K with noise, blurred Vimeo-90K)
 --pathlist     the text file records which are the images for train.
---model        the path of the model used.
+--model        the path of the model used, saved by train.py or a model package (model_package.py, quantize.py).
 --gpuID        the No. of the GPU you want to use.
+--batchSize    the number of sequences per forward pass. default: 1
+--pipeline     read, infer and write in parallel stages. default: False
+--readers      the number of frame reading threads of the pipeline. default: 4
+--writers      the number of PNG writing threads of the pipeline. default: 4
+--queueDepth   the number of batches read ahead by the pipeline. default: 4
+--gtDir        the directory of the ground truth (Vimeo-90K). PSNR/SSIM are reported if provided.
+--profile      write a Chrome trace of the hot paths to this file, and a summary next to it.
+--workers      the number of processes the pathlist is sharded across, on CPU. default: 1
+--threads      the number of intra-op threads of every process. default: the cores divided by --workers
+--precision    fp32, or bf16 to run the convolutions in bfloat16. check it with validate_precision.py first.
+               default: the precision of the model package, or fp32
 --help         get help.""")
     exit(0)
 
@@ -43,6 +74,26 @@ for strOption, strArgument in getopt.getopt(sys.argv[1:], '', [strParameter[2:]
         model_path = strArgument
     elif strOption == '--gpuID':        # gpu id
         gpuID = int(strArgument)
+    elif strOption == '--batchSize':    # batch size
+        batch_size = int(strArgument)
+    elif strOption == '--pipeline':     # pipelined evaluation
+        pipeline = strArgument in ['True', 'true', 'TRUE', '1']
+    elif strOption == '--readers':      # reading threads
+        readers = int(strArgument)
+    elif strOption == '--writers':      # writing threads
+        writers = int(strArgument)
+    elif strOption == '--queueDepth':   # batches read ahead
+        queue_depth = int(strArgument)
+    elif strOption == '--gtDir':        # ground truth dir
+        gt_dir = strArgument
+    elif strOption == '--profile':      # Chrome trace file
+        profile_path = strArgument
+    elif strOption == '--precision':    # inference precision
+        precision = strArgument
+    elif strOption == '--workers':      # evaluation processes
+        workers = int(strArgument)
+    elif strOption == '--threads':      # intra-op threads per process
+        threads = int(strArgument)
 
 if task == '':
     raise ValueError('Missing [--task].\nPlease enter the training task.')
@@ -58,66 +109,345 @@ if pathlistfile == '':
 if model_path == '':
     raise ValueError('Missing [--model model_path].\nPlease provide the path of the toflow model.')
 
+if precision not in ['', 'fp32', 'bf16']:
+    raise ValueError('Invalid [--precision].\nOnly support: [fp32, bf16]')
+
 if gpuID == None:
     cuda_flag = False
 else:
     cuda_flag = True
     torch.cuda.set_device(gpuID)
+
+if workers > 1:
+    if cuda_flag:
+        raise ValueError('[--workers] shards the evaluation across CPU processes, remove [--gpuID].')
+    if pipeline:
+        raise ValueError('[--workers] and [--pipeline] cannot be combined.')
+    if threads == None:
+        threads = max(1, (os.cpu_count() or 1) // workers)
 # --------------------------------------------------------------
 
 def mkdir_if_not_exist(path):
     if not os.path.exists(path):
         os.mkdir(path)
 
-def vimeo_evaluate(input_dir, out_img_dir, test_codelistfile, task='', cuda_flag=True):
-    mkdir_if_not_exist(out_img_dir)
-
-    net = TOFlow(256, 448, cuda_flag=cuda_flag, task=task)
-    net.load_state_dict(torch.load(model_path))
+def load_toflow(task, cuda_flag):
+    # TOFlow takes frames of any size, so one network serves every sequence
+    return load_model(model_path, None, None, task, cuda_flag=cuda_flag, precision=precision or None)
 
-    if cuda_flag:
-        net.cuda().eval()
-    else:
-        net.eval()
 
+def load_codelist(test_codelistfile):
     fp = open(test_codelistfile)
     test_img_list = fp.read().splitlines()
     fp.close()
+    return test_img_list
+
+
+@profiler.traced('evaluate.write')
+def save_prediction(out_img_dir, code, predicted_img):
+    """:param predicted_img: [h, w, n_channels=3]"""
+    out_dir = os.path.join(out_img_dir, code)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir, exist_ok=True)
+    plt.imsave(os.path.join(out_dir, 'out.png'), predicted_img)
+
+
+def shape_groups(arrays):
+    """:return: the lists of the indices of arrays of the same shape"""
+    groups = collections.OrderedDict()
+    for i, array in enumerate(arrays):
+        groups.setdefault(array.shape, []).append(i)
+    return list(groups.values())
+
+
+@profiler.traced('evaluate.forward')
+def run_batch(net, input_frames, cuda_flag):
+    """
+    :param input_frames: a list of [img_num, n_channels=3, h, w] arrays, the sequences of the same size are batched
+    :return: predicted_imgs: a list of [n_channels=3, h, w] tensors
+    """
+    predicted_imgs = [None] * len(input_frames)
+    for indices in shape_groups(input_frames):
+        batch = torch.from_numpy(np.stack([input_frames[i] for i in indices]))
+        if cuda_flag:
+            batch = batch.cuda()
+        for i, predicted_img in zip(indices, net.inference(batch)):
+            predicted_imgs[i] = predicted_img
+    return predicted_imgs
+
+
+def update_metrics(metric_log, codes, predicted_imgs, ground_truth):
+    """
+    :param ground_truth: a list of [n_channels=3, h, w] arrays
+    The sequences of the same size are measured in one batch, like in run_batch.
+    """
+    for indices in shape_groups(ground_truth):
+        metric_log.update([codes[i] for i in indices], torch.stack([predicted_imgs[i] for i in indices]),
+                          torch.from_numpy(np.stack([ground_truth[i] for i in indices])))
+
+
+def to_images(predicted_imgs):
+    """a list of [n_channels=3, h, w] tensors -> a list of [h, w, n_channels=3] arrays"""
+    return [predicted_img.permute(1, 2, 0).cpu().numpy() for predicted_img in predicted_imgs]
+
+
+def write_metric_report(metric_log, out_img_dir):
+    summary = metric_log.summary()
+    print('Mean PSNR: %f\nMean SSIM: %f\nMean Abs: %f' % (summary['psnr'], summary['ssim'], summary['abs']))
+    metric_log.write_json(os.path.join(out_img_dir, 'metrics.json'))
+    metric_log.write_csv(os.path.join(out_img_dir, 'metrics.csv'))
+
+
+def print_stage_report(stage_seconds, count, wall_seconds):
+    """
+    :param stage_seconds: the busy seconds of every stage, summed over its threads
+    """
+    print('Processed %d sequences in %.2fs, %.2f sequences/s.' % (count, wall_seconds, count / wall_seconds))
+    for stage in ['read', 'wait', 'forward', 'metrics', 'write']:
+        if stage_seconds.get(stage):
+            seconds = stage_seconds[stage]
+            print('  %-8s %9.2fs busy\t%8.2f ms/sequence\t%8.2f sequences/busy-second' %
+                  (stage, seconds, seconds / max(count, 1) * 1000, count / seconds if seconds > 0 else float('inf')))
+
+
+def evaluate_codes(net, input_dir, out_img_dir, test_img_list, task, cuda_flag, batch_size, metric_log, gt_dir, log_prefix=''):
+    """
+    Read, enhance and save the sequences of test_img_list one batch after another.
+    :return: the busy seconds of every stage, the number of sequences
+    """
+    process_index, str_format = get_process_index(task)
+    total_count = len(test_img_list)
+    count = 0
+    stage_seconds = {'read': 0.0, 'forward': 0.0, 'metrics': 0.0, 'write': 0.0}
+
+    pre = time.perf_counter()
+    for start in range(0, total_count, batch_size):
+        codes = test_img_list[start:start + batch_size]
+        stage_start = time.perf_counter()
+        # input_frames: batch_size arrays of [img_num, n_channels=3, h, w], the sizes may differ
+        input_frames = [read_sequence(input_dir, code, process_index, str_format) for code in codes]
+        if metric_log:
+            ground_truth = [read_ground_truth(gt_dir, code, task) for code in codes]
+        stage_seconds['read'] += time.perf_counter() - stage_start
+
+        stage_start = time.perf_counter()
+        predicted_imgs = run_batch(net, input_frames, cuda_flag)
+        stage_seconds['forward'] += time.perf_counter() - stage_start
+
+        if metric_log:
+            stage_start = time.perf_counter()
+            update_metrics(metric_log, codes, predicted_imgs, ground_truth)
+            stage_seconds['metrics'] += time.perf_counter() - stage_start
+
+        stage_start = time.perf_counter()
+        for code, predicted_img in zip(codes, to_images(predicted_imgs)):
+            save_prediction(out_img_dir, code, predicted_img)
+        stage_seconds['write'] += time.perf_counter() - stage_start
+
+        count += len(codes)
+        processing_time = (time.perf_counter() - pre) / count
+        print('%s%.3fs per frame.\t%.2fs left.' % (log_prefix, processing_time, processing_time * (total_count - count)))
+    return stage_seconds, count
+
 
-    if task == 'interp':
-        process_index = [1, 3]
-        str_format = 'im%d.png'
-    elif task in ['interp', 'denoise', 'denoising', 'sr', 'super-resolution']:
-        process_index = [1, 2, 3, 4, 5, 6, 7]
-        str_format = 'im%04d.png'
+def vimeo_evaluate(input_dir, out_img_dir, test_codelistfile, task='', cuda_flag=True, batch_size=1, gt_dir=''):
+    mkdir_if_not_exist(out_img_dir)
+    metric_log = MetricLog() if gt_dir else None
+
+    net = load_toflow(task, cuda_flag)
+    test_img_list = load_codelist(test_codelistfile)
+
+    pre = time.perf_counter()
+    stage_seconds, count = evaluate_codes(net, input_dir, out_img_dir, test_img_list, task, cuda_flag, batch_size,
+                                          metric_log, gt_dir)
+    print_stage_report(stage_seconds, count, time.perf_counter() - pre)
+    if metric_log:
+        write_metric_report(metric_log, out_img_dir)
+
+
+def evaluate_shard(rank, state_dict, net_precision, input_dir, out_img_dir, test_img_list, task, batch_size, gt_dir,
+                   threads, results):
+    """
+    the worker process of vimeo_evaluate_sharded, it puts its timings and metrics into results
+    :param state_dict: the weights in shared memory, or None to load the model (int8 weights are repacked anyway)
+    """
+    torch.set_num_threads(threads)
+    if state_dict is None:
+        net = load_toflow(task, False)
+    else:
+        net = build_toflow(state_dict, None, None, task)
+        net.set_precision(net_precision)
+    if profile_path:
+        profiler.enable()
+    metric_log = MetricLog() if gt_dir else None
+    pre = time.perf_counter()
+    stage_seconds, count = evaluate_codes(net, input_dir, out_img_dir, test_img_list, task, False, batch_size,
+                                          metric_log, gt_dir, log_prefix='[worker %d] ' % rank)
+    wall_seconds = time.perf_counter() - pre
+    if profile_path:
+        profiler.write_report('%s_worker%d%s' % (os.path.splitext(profile_path)[0], rank, os.path.splitext(profile_path)[1]))
+    results.put({'rank': rank, 'count': count, 'wall_seconds': wall_seconds, 'stage_seconds': stage_seconds,
+                 'records': metric_log.records if metric_log else []})
+
+
+def vimeo_evaluate_sharded(input_dir, out_img_dir, test_codelistfile, task='', batch_size=1, gt_dir='', workers=2, threads=1):
+    """
+    vimeo_evaluate with the pathlist sharded across worker processes of threads intra-op threads each.
+    The weights are loaded once and moved to shared memory, the workers map them instead of copying.
+    The outputs, metrics.json/metrics.csv and a merged timing.json are written to out_img_dir.
+    """
+    mkdir_if_not_exist(out_img_dir)
+    net = load_toflow(task, False)
+    if hasattr(net, 'backend'):
+        # int8 weights are packed for the quantized engine by every process
+        state_dict = None
     else:
-        raise ValueError('Invalid [--task].\nOnly support: [interp, denoise/denoising, sr/super-resolution]')
+        state_dict = net.share_memory().state_dict()
+    test_img_list = load_codelist(test_codelistfile)
+
+    context = torch.multiprocessing.get_context('spawn')
+    results = context.Queue()
+    pre = time.perf_counter()
+    processes = [context.Process(target=evaluate_shard,
+                                 args=(rank, state_dict, net.precision, input_dir, out_img_dir, test_img_list[rank::workers], task,
+                                       batch_size, gt_dir, threads, results))
+                 for rank in range(workers)]
+    for process in processes:
+        process.start()
+    shards = []
+    while len(shards) < workers:
+        try:
+            shards.append(results.get(timeout=1))
+        except queue.Empty:
+            for process in processes:
+                if process.exitcode not in [None, 0]:
+                    raise RuntimeError('Evaluation worker %d failed with exit code %d.' % (processes.index(process), process.exitcode))
+    for process in processes:
+        process.join()
+    wall_seconds = time.perf_counter() - pre
+
+    shards.sort(key=lambda shard: shard['rank'])
+    count = sum(shard['count'] for shard in shards)
+    stage_seconds = dict((stage, sum(shard['stage_seconds'][stage] for shard in shards)) for stage in shards[0]['stage_seconds'])
+    print_stage_report(stage_seconds, count, wall_seconds)
+    for shard in shards:
+        print('  worker %-3d %5d sequences in %.2fs, %.2f sequences/s' %
+              (shard['rank'], shard['count'], shard['wall_seconds'], shard['count'] / shard['wall_seconds']))
+    with open(os.path.join(out_img_dir, 'timing.json'), 'w') as fp:
+        json.dump({'workers': workers, 'threads': threads, 'count': count, 'wall_seconds': wall_seconds,
+                   'sequences_per_second': count / wall_seconds, 'stage_seconds': stage_seconds,
+                   'shards': [dict((key, shard[key]) for key in ['rank', 'count', 'wall_seconds', 'stage_seconds'])
+                              for shard in shards]}, fp, indent=2)
+
+    if gt_dir:
+        # in the order of the pathlist, as a single process writes them
+        order = dict((code, i) for i, code in enumerate(test_img_list))
+        metric_log = MetricLog()
+        metric_log.extend(sorted([record for shard in shards for record in shard['records']], key=lambda record: order[record['code']]))
+        write_metric_report(metric_log, out_img_dir)
+
+
+def vimeo_evaluate_pipelined(input_dir, out_img_dir, test_codelistfile, task='', cuda_flag=True, batch_size=1,
+                             readers=4, writers=4, queue_depth=4, gt_dir=''):
+    """
+    vimeo_evaluate with overlapping stages: a pool of reader threads fills a queue of at most
+    queue_depth batches, the main thread runs the batched forwards, and a pool of writer threads
+    saves the predictions.
+    """
+    mkdir_if_not_exist(out_img_dir)
+    metric_log = MetricLog() if gt_dir else None
+
+    net = load_toflow(task, cuda_flag)
+    test_img_list = load_codelist(test_codelistfile)
+    process_index, str_format = get_process_index(task)
     total_count = len(test_img_list)
     count = 0
+    stage_seconds = {'read': 0.0, 'wait': 0.0, 'forward': 0.0, 'metrics': 0.0, 'write': 0.0}
+    stage_lock = threading.Lock()
 
-    pre = datetime.datetime.now()
-    for code in test_img_list:
-        # print('Processing %s...' % code)
-        count += 1
-        video = code.split('/')[0]
-        sep = code.split('/')[1]
-        mkdir_if_not_exist(os.path.join(out_img_dir, video))
-        mkdir_if_not_exist(os.path.join(out_img_dir, video, sep))
-        input_frames = []
-        for i in process_index:
-            input_frames.append(plt.imread(os.path.join(input_dir, code, str_format % i)))
-        input_frames = np.transpose(np.array(input_frames), (0, 3, 1, 2))
+    def timed(stage, function, *args):
+        stage_start = time.perf_counter()
+        result = function(*args)
+        with stage_lock:
+            stage_seconds[stage] += time.perf_counter() - stage_start
+        return result
 
-        if cuda_flag:
-            input_frames = torch.from_numpy(input_frames).cuda()
-        else:
-            input_frames = torch.from_numpy(input_frames)
-        input_frames = input_frames.view(1, input_frames.size(0), input_frames.size(1), input_frames.size(2), input_frames.size(3))
-        predicted_img = net(input_frames)[0, :, :, :]
-        plt.imsave(os.path.join(out_img_dir, video, sep, 'out.png'),predicted_img.permute(1, 2, 0).cpu().detach().numpy())
+    read_pool = concurrent.futures.ThreadPoolExecutor(max_workers=readers)
+    write_pool = concurrent.futures.ThreadPoolExecutor(max_workers=writers)
+    ready = queue.Queue(maxsize=queue_depth)
+
+    def read_item(code):
+        if metric_log:
+            return read_sequence(input_dir, code, process_index, str_format), read_ground_truth(gt_dir, code, task)
+        return read_sequence(input_dir, code, process_index, str_format), None
+
+    def produce():
+        for start in range(0, total_count, batch_size):
+            codes = test_img_list[start:start + batch_size]
+            ready.put((codes, [read_pool.submit(timed, 'read', read_item, code) for code in codes]))
+        ready.put(None)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    pre = time.perf_counter()
+    producer.start()
+    pending_writes = collections.deque()
+    try:
+        while True:
+            stage_start = time.perf_counter()
+            item = ready.get()
+            if item is None:
+                break
+            codes, futures = item
+            items = [future.result() for future in futures]
+            input_frames = [item[0] for item in items]
+            stage_seconds['wait'] += time.perf_counter() - stage_start
+
+            stage_start = time.perf_counter()
+            predicted_imgs = run_batch(net, input_frames, cuda_flag)
+            stage_seconds['forward'] += time.perf_counter() - stage_start
+
+            if metric_log:
+                stage_start = time.perf_counter()
+                update_metrics(metric_log, codes, predicted_imgs, [item[1] for item in items])
+                stage_seconds['metrics'] += time.perf_counter() - stage_start
+
+            for code, predicted_img in zip(codes, to_images(predicted_imgs)):
+                pending_writes.append(write_pool.submit(timed, 'write', save_prediction, out_img_dir, code, predicted_img))
+            # bound the predictions waiting to be written
+            while len(pending_writes) > queue_depth * batch_size:
+                pending_writes.popleft().result()
 
-        cur = datetime.datetime.now()
-        processing_time = (cur - pre).seconds / count
-        print('%.2fs per frame.\t%.2fs left.' % (processing_time, processing_time * (total_count - count)))
+            count += len(codes)
+            processing_time = (time.perf_counter() - pre) / count
+            print('%.3fs per frame.\t%.2fs left.' % (processing_time, processing_time * (total_count - count)))
+
+        while pending_writes:
+            pending_writes.popleft().result()
+    finally:
+        read_pool.shutdown()
+        write_pool.shutdown()
+
+    print_stage_report(stage_seconds, count, time.perf_counter() - pre)
+    if metric_log:
+        write_metric_report(metric_log, out_img_dir)
+
+
+# the workers of vimeo_evaluate_sharded import this file again, only the main process evaluates.
+if __name__ == '__main__':
+    if workers > 1:
+        vimeo_evaluate_sharded(dataset_dir, './evaluate', pathlistfile, task=task, batch_size=batch_size, gt_dir=gt_dir,
+                               workers=workers, threads=threads)
+    else:
+        if threads != None:
+            torch.set_num_threads(threads)
+        if profile_path:
+            profiler.enable()
+
+        if pipeline:
+            vimeo_evaluate_pipelined(dataset_dir, './evaluate', pathlistfile, task=task, cuda_flag=cuda_flag, batch_size=batch_size,
+                                     readers=readers, writers=writers, queue_depth=queue_depth, gt_dir=gt_dir)
+        else:
+            vimeo_evaluate(dataset_dir, './evaluate', pathlistfile, task=task, cuda_flag=cuda_flag, batch_size=batch_size, gt_dir=gt_dir)
 
-vimeo_evaluate(dataset_dir, './evaluate', pathlistfile, task=task, cuda_flag=cuda_flag)
\ No newline at end of file
+        if profile_path:
+            profiler.write_report(profile_path)
@@ -0,0 +1,102 @@
+import sys
+import json
+import time
+import getopt
+import threading
+import urllib.request
+import numpy as np
+from server import img_nums, task_aliases, encode_array, decode_array
+from profiling import percentile
+
+
+def post_window(url, task, frames):
+    request = urllib.request.Request('%s/enhance/%s' % (url, task), data=encode_array(frames),
+                                     headers={'Content-Type': 'application/octet-stream'})
+    with urllib.request.urlopen(request) as response:
+        return decode_array(response.read())
+
+
+def fetch_metrics(url):
+    with urllib.request.urlopen(url + '/metrics') as response:
+        return json.loads(response.read())
+
+
+def generate_load(url, task, sizes, n_requests, concurrency, seed=0):
+    """
+    Send n_requests random frame windows of the given sizes from concurrency client threads.
+    :return: the latency of every request in ms and the wall time in seconds
+    """
+    rng = np.random.RandomState(seed)
+    windows = [rng.randint(0, 256, (img_nums[task], height, width, 3), dtype=np.uint8) for height, width in sizes]
+    latencies = []
+    next_request = [0]
+    lock = threading.Lock()
+
+    def client():
+        while True:
+            with lock:
+                i = next_request[0]
+                if i >= n_requests:
+                    return
+                next_request[0] += 1
+            frames = windows[i % len(windows)]
+            start = time.perf_counter()
+            output = post_window(url, task, frames)
+            latency = (time.perf_counter() - start) * 1000
+            assert output.shape == frames.shape[1:]
+            with lock:
+                latencies.append(latency)
+
+    pre = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, time.perf_counter() - pre
+
+
+if __name__ == '__main__':
+    url = 'http://127.0.0.1:8080'
+    task = 'denoise'
+    sizes = [(256, 448)]
+    n_requests = 64
+    concurrency = 8
+
+    if len(sys.argv) > 1 and sys.argv[1] in ['-h', '--help']:
+        print("""pytoflow version 1.1
+usage: python3 load_generator.py [[option] [value]]...
+options:
+--url          the address of server.py. default: http://127.0.0.1:8080
+--task         the task to send frame windows to. default: denoise
+--sizes        the frame sizes to cycle through, like 256x448,448x256. default: 256x448
+--requests     the number of frame windows to send. default: 64
+--concurrency  the number of client threads. default: 8
+-h, --help     get help.""")
+        exit(0)
+
+    for strOption, strArgument in getopt.getopt(sys.argv[1:], '', [strParameter[2:] + '=' for strParameter in sys.argv[1::2]])[0]:
+        if strOption == '--url':
+            url = strArgument.rstrip('/')
+        elif strOption == '--task':
+            task = task_aliases.get(strArgument, strArgument)
+        elif strOption == '--sizes':
+            sizes = [tuple(int(x) for x in size.split('x')) for size in strArgument.split(',')]
+        elif strOption == '--requests':
+            n_requests = int(strArgument)
+        elif strOption == '--concurrency':
+            concurrency = int(strArgument)
+
+    if task not in img_nums:
+        raise ValueError('Invalid [--task].\nOnly support: [interp, denoise/denoising, sr/super-resolution]')
+
+    latencies, seconds = generate_load(url, task, sizes, n_requests, concurrency)
+    latencies.sort()
+    print('%d requests in %.2fs, %.2f requests/s.' % (len(latencies), seconds, len(latencies) / seconds))
+    print('Latency (ms): mean %.1f, p50 %.1f, p90 %.1f, p99 %.1f, max %.1f' %
+          (sum(latencies) / len(latencies), percentile(latencies, 50), percentile(latencies, 90),
+           percentile(latencies, 99), latencies[-1]))
+    metrics = fetch_metrics(url)
+    if task in metrics['batch_size']:
+        print('Server batch size: mean %.2f, max %d' % (metrics['batch_size'][task]['mean'], metrics['batch_size'][task]['max']))
+    print(json.dumps(metrics, indent=2))
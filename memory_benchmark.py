@@ -0,0 +1,139 @@
+import sys
+import json
+import time
+import getopt
+import resource
+import torch
+import torch.multiprocessing
+from Network import TOFlow
+
+tasks = ['interp', 'denoise', 'sr']
+img_nums = {'interp': 2, 'denoise': 7, 'sr': 7}
+
+
+def peak_bytes(cuda_flag):
+    """:return: the peak memory of this process so far, allocated tensors on GPU and resident memory on CPU"""
+    if cuda_flag:
+        return torch.cuda.max_memory_allocated()
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class SavedTensors(object):
+    """count the bytes of the distinct tensors autograd keeps for backward"""
+    def __init__(self):
+        self.storages = {}
+
+    def pack(self, tensor):
+        storage = tensor.untyped_storage()
+        self.storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    def nbytes(self):
+        return sum(self.storages.values())
+
+
+def measure_step(task, height, width, batch_size, checkpointing, cuda_flag, threads, results):
+    """
+    Run a single training step, forward, L1 loss and backward, on random frames with random weights.
+    Started in a fresh process, so that the peak memory of the step is not hidden by an earlier one.
+    """
+    torch.set_num_threads(threads)
+    torch.manual_seed(0)
+    net = TOFlow(height, width, task=task, cuda_flag=cuda_flag, pretrained=False).set_checkpointing(checkpointing)
+    device = torch.device('cuda') if cuda_flag else torch.device('cpu')
+    net.to(device)
+    # a tiny step first, so that the one-off allocations of the kernels are not counted
+    torch.nn.functional.l1_loss(net(torch.rand(1, img_nums[task], 3, 32, 32, device=device)),
+                                torch.rand(1, 3, 32, 32, device=device)).backward()
+    net.zero_grad()
+    frames = torch.rand(batch_size, img_nums[task], 3, height, width, device=device)
+    ground_truth = torch.rand(batch_size, 3, height, width, device=device)
+    if cuda_flag:
+        torch.cuda.reset_peak_memory_stats()
+    saved = SavedTensors()
+    before = peak_bytes(cuda_flag)
+    start = time.perf_counter()
+    with torch.autograd.graph.saved_tensors_hooks(saved.pack, lambda tensor: tensor):
+        loss = torch.nn.functional.l1_loss(net(frames), ground_truth)
+    loss.backward()
+    if cuda_flag:
+        torch.cuda.synchronize()
+    seconds = time.perf_counter() - start
+    results.put({'task': task, 'height': height, 'width': width, 'batch': batch_size, 'checkpointing': checkpointing,
+                 'saved_mb': saved.nbytes() / 1024 ** 2, 'step_peak_mb': (peak_bytes(cuda_flag) - before) / 1024 ** 2,
+                 'step_ms': seconds * 1000})
+
+
+def run_benchmarks(selected, sizes, batch_sizes, cuda_flag=False, threads=1):
+    context = torch.multiprocessing.get_context('spawn')
+    results = context.Queue()
+    report = []
+    for task in selected:
+        for height, width in sizes:
+            for batch_size in batch_sizes:
+                pair = []
+                for checkpointing in [False, True]:
+                    process = context.Process(target=measure_step, args=(task, height, width, batch_size, checkpointing,
+                                                                         cuda_flag, threads, results))
+                    process.start()
+                    pair.append(results.get())
+                    process.join()
+                off, on = pair
+                print('%-8s %5dx%-5d batch %2d  kept for backward %7.1f MB -> %7.1f MB  peak %7.1f MB -> %7.1f MB (x%.2f)  '
+                      'step %8.1f ms -> %8.1f ms (x%.2f)' %
+                      (task, height, width, batch_size, off['saved_mb'], on['saved_mb'], off['step_peak_mb'], on['step_peak_mb'],
+                       on['step_peak_mb'] / off['step_peak_mb'], off['step_ms'], on['step_ms'], on['step_ms'] / off['step_ms']))
+                report += pair
+    return report
+
+
+if __name__ == '__main__':
+    selected = list(tasks)
+    sizes = [(256, 448)]
+    batch_sizes = [1]
+    gpuID = None
+    threads = 1
+    out_file = 'memory_benchmark.json'
+
+    if len(sys.argv) > 1 and sys.argv[1] in ['-h', '--help']:
+        print("""pytoflow version 1.1
+usage: python3 memory_benchmark.py [[option] [value]]...
+options:
+--tasks        the tasks to measure. default: interp,denoise,sr
+--sizes        the frame sizes to measure. default: 256x448
+--batchSizes   the batch sizes to measure. default: 1
+--threads      the number of intra-op threads. default: 1
+--out          the JSON file to write the results to. default: memory_benchmark.json
+--gpuID        the No. of the GPU you want to use. default: no gpu.
+-h, --help     get help.""")
+        exit(0)
+
+    for strOption, strArgument in getopt.getopt(sys.argv[1:], '', [strParameter[2:] + '=' for strParameter in sys.argv[1::2]])[0]:
+        if strOption == '--tasks':
+            selected = strArgument.split(',')
+        elif strOption == '--sizes':
+            sizes = [tuple(int(x) for x in size.split('x')) for size in strArgument.split(',')]
+        elif strOption == '--batchSizes':
+            batch_sizes = [int(x) for x in strArgument.split(',')]
+        elif strOption == '--threads':
+            threads = int(strArgument)
+        elif strOption == '--out':
+            out_file = strArgument
+        elif strOption == '--gpuID':
+            gpuID = int(strArgument)
+
+    for task in selected:
+        if task not in tasks:
+            raise ValueError('Invalid [--tasks].\nOnly support: [%s]' % ', '.join(tasks))
+
+    if gpuID == None:
+        cuda_flag = False
+    else:
+        cuda_flag = True
+        torch.cuda.set_device(gpuID)
+
+    report = run_benchmarks(selected, sizes, batch_sizes, cuda_flag=cuda_flag, threads=threads)
+    with open(out_file, 'w') as fp:
+        json.dump({'torch': torch.__version__, 'results': report}, fp, indent=2)
+    print('Results saved to %s.' % out_file)
@@ -0,0 +1,129 @@
+import csv
+import json
+import math
+import torch
+
+# the same constants as the ssim of MATLAB used by evaluation/run_eval_template.m
+ssim_sigma = 1.5
+ssim_filter_size = 11
+ssim_K1 = 0.01
+ssim_K2 = 0.03
+
+
+def quantize(img):
+    """round the predictions to 8 bits like plt.imsave does, so the metrics match the saved out.png"""
+    return torch.floor(img.clamp(0, 1) * 255.0) / 255.0
+
+
+def psnr(img, ref):
+    """
+    :param img: [batch_size, n_channels=3, h, w] in [0, 1]
+    :param ref: [batch_size, n_channels=3, h, w] in [0, 1]
+    :return: [batch_size] PSNR in dB over all channels, as psnr of MATLAB
+    """
+    mse = ((img - ref) ** 2).flatten(1).mean(1)
+    return 10 * torch.log10(1.0 / mse)
+
+
+def gaussian_window(device, dtype):
+    radius = ssim_filter_size // 2
+    x = torch.arange(-radius, radius + 1, device=device, dtype=dtype)
+    window = torch.exp(-x ** 2 / (2 * ssim_sigma ** 2))
+    return window / window.sum()
+
+
+def gaussian_filter3(x):
+    """
+    separable 3-D Gaussian filter with replicate padding, over (channel, h, w) of x: [batch_size, 1, n_channels, h, w].
+    MATLAB filters RGB images as 3-D volumes (imgaussfilt3), so the channels are blurred as well.
+    """
+    window = gaussian_window(x.device, x.dtype)
+    radius = ssim_filter_size // 2
+    x = torch.nn.functional.pad(x, [radius] * 6, mode='replicate')
+    x = torch.nn.functional.conv3d(x, window.view(1, 1, -1, 1, 1))
+    x = torch.nn.functional.conv3d(x, window.view(1, 1, 1, -1, 1))
+    x = torch.nn.functional.conv3d(x, window.view(1, 1, 1, 1, -1))
+    return x
+
+
+def ssim(img, ref):
+    """
+    :param img: [batch_size, n_channels=3, h, w] in [0, 1]
+    :param ref: [batch_size, n_channels=3, h, w] in [0, 1]
+    :return: [batch_size] mean SSIM, as ssim of MATLAB on RGB images
+    """
+    img = img.double().unsqueeze(1)
+    ref = ref.double().unsqueeze(1)
+    C1 = ssim_K1 ** 2
+    C2 = ssim_K2 ** 2
+    mu_img = gaussian_filter3(img)
+    mu_ref = gaussian_filter3(ref)
+    sigma_img = gaussian_filter3(img * img) - mu_img ** 2
+    sigma_ref = gaussian_filter3(ref * ref) - mu_ref ** 2
+    sigma_both = gaussian_filter3(img * ref) - mu_img * mu_ref
+    ssim_map = ((2 * mu_img * mu_ref + C1) * (2 * sigma_both + C2)) / \
+               ((mu_img ** 2 + mu_ref ** 2 + C1) * (sigma_img + sigma_ref + C2))
+    return ssim_map.flatten(1).mean(1).float()
+
+
+def mean_abs(img, ref):
+    """:return: [batch_size] mean absolute error"""
+    return (img - ref).abs().flatten(1).mean(1)
+
+
+class MetricLog(object):
+    """
+    Streaming PSNR/SSIM/abs of every sequence and their running means,
+    written as a JSON or CSV report at the end.
+    """
+    names = ['psnr', 'ssim', 'abs']
+
+    def __init__(self):
+        self.records = []
+        self.sums = dict((name, 0.0) for name in self.names)
+        self.count = 0
+
+    def update(self, codes, img, ref):
+        """
+        :param codes: the path codes of the batch
+        :param img: the predictions [batch_size, n_channels=3, h, w]
+        :param ref: the ground truth [batch_size, n_channels=3, h, w]
+        """
+        img = quantize(img)
+        ref = ref.to(img.device, img.dtype)
+        values = {'psnr': psnr(img, ref), 'ssim': ssim(img, ref), 'abs': mean_abs(img, ref)}
+        values = dict((name, value.tolist()) for name, value in values.items())
+        for i, code in enumerate(codes):
+            record = {'code': code}
+            for name in self.names:
+                record[name] = values[name][i]
+                self.sums[name] += values[name][i]
+            self.records.append(record)
+        self.count += len(codes)
+
+    def extend(self, records):
+        """add the records of another MetricLog, like the one of another process"""
+        for record in records:
+            for name in self.names:
+                self.sums[name] += record[name]
+            self.records.append(record)
+        self.count += len(records)
+
+    def summary(self):
+        return dict((name, self.sums[name] / self.count if self.count else math.nan) for name in self.names)
+
+    def write_json(self, path, extra=None):
+        report = {'count': self.count, 'mean': self.summary(), 'sequences': self.records}
+        if extra:
+            report.update(extra)
+        with open(path, 'w') as fp:
+            json.dump(report, fp, indent=2)
+
+    def write_csv(self, path):
+        with open(path, 'w', newline='') as fp:
+            writer = csv.DictWriter(fp, fieldnames=['code'] + self.names)
+            writer.writeheader()
+            writer.writerows(self.records)
+            row = {'code': 'mean'}
+            row.update(self.summary())
+            writer.writerow(row)
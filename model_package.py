@@ -0,0 +1,144 @@
+import sys
+import time
+import getopt
+import zipfile
+import torch
+from Network import TOFlow, precisions
+
+package_format = 'toflow-package'
+package_version = 1
+task_aliases = {'denoising': 'denoise', 'super-resolution': 'sr'}
+
+
+def same_task(task, other):
+    return task_aliases.get(task, task) == task_aliases.get(other, other)
+
+
+def save_package(net, path, precision=None):
+    """
+    Save net as a single file bundling its weights, task, resolution, precision and quantization.
+    :param precision: the precision to run the model in once loaded. default: net.precision
+    """
+    package = {'format': package_format, 'version': package_version,
+               'task': net.task, 'height': net.height, 'width': net.width,
+               'precision': precision or net.precision,
+               'quantization': {'scheme': 'int8', 'backend': net.backend} if hasattr(net, 'backend') else None,
+               'state_dict': net.state_dict()}
+    torch.save(package, path)
+
+
+def is_package(checkpoint):
+    return isinstance(checkpoint, dict) and checkpoint.get('format') == package_format
+
+
+def load_weights(model_path):
+    """
+    Load a package or a state dict without copying the weights: files in the zip format of torch.save
+    are memory-mapped and their tensors are only read from disk when used.
+    """
+    return torch.load(model_path, map_location='cpu', weights_only=True, mmap=zipfile.is_zipfile(model_path))
+
+
+def build_toflow(state_dict, h, w, task, cuda_flag=False):
+    """
+    Construct TOFlow around state_dict. The modules are created on the meta device and the tensors of
+    state_dict are assigned to them, so neither the random initialization nor the SpyNet weights are computed.
+    """
+    with torch.device('meta'):
+        net = TOFlow(h, w, task=task, cuda_flag=cuda_flag, pretrained=False)
+    net.load_state_dict(state_dict, assign=True)
+    if cuda_flag:
+        net.cuda()
+    return net.eval()
+
+
+def load_package(package, cuda_flag=False, precision=None, h=None, w=None):
+    """
+    :param package: a package loaded by load_weights
+    :param precision: overrides the precision of the package
+    :param h, w: override the resolution of the package
+    :return: TOFlow in eval mode
+    """
+    if package['version'] > package_version:
+        raise ValueError('The model package is version %d, this pytoflow reads up to version %d.' %
+                         (package['version'], package_version))
+    h = h or package['height']
+    w = w or package['width']
+    if package['quantization']:
+        if cuda_flag:
+            raise ValueError('int8 models only run on CPU, remove [--gpuID].')
+        # quantize imports the data pipeline, so only int8 packages pay for it
+        from quantize import load_int8_toflow
+        net = load_int8_toflow(package['state_dict'], h, w, package['task'], package['quantization']['backend'])
+    else:
+        net = build_toflow(package['state_dict'], h, w, package['task'], cuda_flag=cuda_flag)
+    net.set_precision(precision or package['precision'])
+    return net
+
+
+def load_model(model_path, h, w, task, cuda_flag=False, precision=None):
+    """
+    Load a model package, or a bare TOFlow state dict saved by train.py.
+    :param h, w: the nominal resolution of a bare state dict, or None. a package keeps its own unless given.
+                 the model takes frames of any size either way.
+    :param precision: 'fp32' or 'bf16'. default: the precision of the package, or fp32
+    :return: TOFlow in eval mode
+    """
+    checkpoint = load_weights(model_path)
+    if is_package(checkpoint):
+        if not same_task(task, checkpoint['task']):
+            raise ValueError('%s is a model for [%s], not [%s].' % (model_path, checkpoint['task'], task))
+        return load_package(checkpoint, cuda_flag=cuda_flag, precision=precision, h=h, w=w)
+    net = build_toflow(checkpoint, h, w, task, cuda_flag=cuda_flag)
+    net.set_precision(precision or 'fp32')
+    return net
+
+
+if __name__ == '__main__':
+    task = ''
+    model_path = ''
+    out_path = ''
+    height = 256
+    width = 448
+    precision = 'fp32'
+
+    if len(sys.argv) < 2 or sys.argv[1] in ['-h', '--help']:
+        print("""pytoflow version 1.1
+usage: python3 model_package.py [[option] [value]]...
+options:
+--task         the task of the model, like interp, denoising, super-resolution
+               valid values:[interp, denoise, denoising, sr, super-resolution]
+--model        the path of the model saved by train.py.
+--out          the path of the model package to write.
+--height       the nominal frame height recorded in the package. default: 256
+--width        the nominal frame width recorded in the package. default: 448
+--precision    the precision the package runs in, fp32 or bf16. default: fp32
+-h, --help     get help.""")
+        exit(0)
+
+    for strOption, strArgument in getopt.getopt(sys.argv[1:], '', [strParameter[2:] + '=' for strParameter in sys.argv[1::2]])[0]:
+        if strOption == '--task':
+            task = strArgument
+        elif strOption == '--model':
+            model_path = strArgument
+        elif strOption == '--out':
+            out_path = strArgument
+        elif strOption == '--height':
+            height = int(strArgument)
+        elif strOption == '--width':
+            width = int(strArgument)
+        elif strOption == '--precision':
+            precision = strArgument
+
+    if task not in ['interp', 'denoise', 'denoising', 'sr', 'super-resolution']:
+        raise ValueError('Invalid [--task].\nOnly support: [interp, denoise/denoising, sr/super-resolution]')
+    if model_path == '' or out_path == '':
+        raise ValueError('Missing [--model or --out].\nPlease provide the model and the path of the package.')
+    if precision not in precisions:
+        raise ValueError('Invalid [--precision].\nOnly support: [%s]' % ', '.join(precisions))
+
+    net = load_model(model_path, height, width, task)
+    save_package(net, out_path, precision=precision)
+    start = time.perf_counter()
+    load_model(out_path, None, None, task)
+    print('Model package saved to %s, loaded in %.1fms.' % (out_path, (time.perf_counter() - start) * 1000))
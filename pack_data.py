@@ -0,0 +1,53 @@
+import sys
+import getopt
+from read_data import MemoryFriendlyLoader, pack_dataset
+
+task = ''
+dataset_dir = ''
+edited_img_dir = ''
+pathlistfile = ''
+pack_dir = ''
+shard_size = 4096   # MB
+
+if len(sys.argv) < 2 or sys.argv[1] in ['-h', '--help']:
+    print("""pytoflow version 1.1
+usage: python3 pack_data.py [[option] [value]]...
+options:
+--task         training task, like interp, denoising, super-resolution
+               valid values:[interp, denoise, denoising, sr, super-resolution]
+--dataDir      the directory of the image dataset(Vimeo-90K)
+--ex_dataDir   the directory of the preprocessed image dataset, for example, the Vimeo-90K mixed by Gaussian noise.
+--pathlist     the text file records which are the images to pack.
+--packDir      the directory to write the shards and their index into.
+--shardSize    the maximum size (MB) of a shard. default: 4096
+-h, --help     get help.""")
+    exit(0)
+
+for strOption, strArgument in getopt.getopt(sys.argv[1:], '', [strParameter[2:] + '=' for strParameter in sys.argv[1::2]])[0]:
+    if strOption == '--task':
+        task = strArgument
+    elif strOption == '--dataDir':
+        dataset_dir = strArgument
+    elif strOption == '--ex_dataDir':
+        edited_img_dir = strArgument
+    elif strOption == '--pathlist':
+        pathlistfile = strArgument
+    elif strOption == '--packDir':
+        pack_dir = strArgument
+    elif strOption == '--shardSize':
+        shard_size = int(strArgument)
+
+if task not in ['interp', 'denoise', 'denoising', 'sr', 'super-resolution']:
+    raise ValueError('Invalid [--task].\nOnly support: [interp, denoise/denoising, sr/super-resolution]')
+if dataset_dir == '':
+    raise ValueError('Missing [--dataDir].\nPlease provide the directory of the dataset. (Vimeo-90K)')
+if task != 'interp' and edited_img_dir == '':
+    raise ValueError('Missing [--ex_dataDir].\nPlease provide the directory of the edited image dataset.')
+if pathlistfile == '':
+    raise ValueError('Missing [--pathlist].\nPlease provide the pathlist index file.')
+if pack_dir == '':
+    raise ValueError('Missing [--packDir].\nPlease provide the directory of the packed dataset.')
+
+Dataset = MemoryFriendlyLoader(origin_img_dir=dataset_dir, edited_img_dir=edited_img_dir, pathlistfile=pathlistfile, task=task)
+index = pack_dataset(Dataset, pack_dir, shard_bytes=shard_size * 1024 * 1024)
+print('Packed %d samples into %d shards in %s.' % (len(index['entries']), len(index['shards']), pack_dir))
@@ -0,0 +1,156 @@
+import os
+import json
+import time
+import resource
+import threading
+import functools
+import torch
+
+
+class NullSpan(object):
+    """the span handed out while profiling is disabled, it does nothing"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set_output(self, output):
+        pass
+
+
+null_span = NullSpan()
+
+
+def output_bytes(output):
+    """the total size in bytes of the tensors in output"""
+    if isinstance(output, torch.Tensor):
+        return output.numel() * output.element_size()
+    if isinstance(output, (list, tuple)):
+        return sum(output_bytes(item) for item in output)
+    return 0
+
+
+def peak_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Span(object):
+    def __init__(self, profiler, name, args):
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.record(self.name, self.start, time.perf_counter(), self.args)
+        return False
+
+    def set_output(self, output):
+        self.args['out_bytes'] = output_bytes(output)
+
+
+class Profiler(object):
+    """
+    Records the latency of the hot paths as complete events of the Chrome trace format,
+    together with the size of the tensors they allocate and the peak RSS of the process.
+    While disabled, span() returns null_span and traced functions only check a flag.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.origin = time.perf_counter()
+        self.pid = os.getpid()
+
+    def enable(self):
+        self.events = []
+        self.origin = time.perf_counter()
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def span(self, name, **args):
+        if not self.enabled:
+            return null_span
+        return Span(self, name, args)
+
+    def record(self, name, start, end, args=None):
+        args = dict(args) if args else {}
+        args['peak_rss'] = peak_rss_bytes()
+        # list.append is atomic, so threads can record without a lock
+        self.events.append({'name': name, 'ph': 'X', 'pid': self.pid, 'tid': threading.get_ident(),
+                            'ts': (start - self.origin) * 1e6, 'dur': (end - start) * 1e6, 'args': args})
+
+    def traced(self, name):
+        """decorator recording every call of a function as a span, with the size of its returned tensors"""
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                start = time.perf_counter()
+                output = function(*args, **kwargs)
+                self.record(name, start, time.perf_counter(), {'out_bytes': output_bytes(output)})
+                return output
+            return wrapper
+        return decorator
+
+    def export_chrome_trace(self, path):
+        """write the events as a Chrome trace, open it in chrome://tracing or https://ui.perfetto.dev"""
+        events = list(self.events)
+        counters = [{'name': 'peak_rss', 'ph': 'C', 'pid': self.pid, 'ts': event['ts'] + event['dur'],
+                     'args': {'bytes': event['args']['peak_rss']}} for event in events]
+        with open(path, 'w') as fp:
+            json.dump({'traceEvents': events + counters, 'displayTimeUnit': 'ms'}, fp)
+
+    def summary(self):
+        """
+        :return: {name: statistics of its latency in ms, with a histogram over power-of-two millisecond buckets}
+        """
+        durations = {}
+        out_bytes = {}
+        for event in list(self.events):
+            durations.setdefault(event['name'], []).append(event['dur'] / 1000)
+            out_bytes[event['name']] = max(out_bytes.get(event['name'], 0), event['args'].get('out_bytes', 0))
+        summary = {}
+        for name, values in durations.items():
+            values.sort()
+            histogram = {}
+            for value in values:
+                if value < 1:
+                    key = '<1'
+                else:
+                    bucket = 2 ** (int(value).bit_length() - 1)
+                    key = '%d-%d' % (bucket, bucket * 2)
+                histogram[key] = histogram.get(key, 0) + 1
+            summary[name] = {'count': len(values), 'total_ms': sum(values), 'mean_ms': sum(values) / len(values),
+                             'p50_ms': percentile(values, 50), 'p90_ms': percentile(values, 90),
+                             'p99_ms': percentile(values, 99), 'max_ms': values[-1],
+                             'max_out_bytes': out_bytes[name], 'histogram_ms': histogram}
+        return summary
+
+    def write_report(self, trace_path):
+        """write the Chrome trace to trace_path, the summary next to it, and print the summary"""
+        self.export_chrome_trace(trace_path)
+        summary = self.summary()
+        summary_path = os.path.splitext(trace_path)[0] + '_summary.json'
+        with open(summary_path, 'w') as fp:
+            json.dump({'peak_rss': peak_rss_bytes(), 'spans': summary}, fp, indent=2)
+        print('%-24s %7s %11s %9s %9s %9s %9s' % ('span', 'count', 'total(ms)', 'mean', 'p50', 'p90', 'p99'))
+        for name, stats in sorted(summary.items(), key=lambda item: -item[1]['total_ms']):
+            print('%-24s %7d %11.1f %9.2f %9.2f %9.2f %9.2f' % (name, stats['count'], stats['total_ms'], stats['mean_ms'],
+                                                              stats['p50_ms'], stats['p90_ms'], stats['p99_ms']))
+        print('Peak RSS %.1fMB. Trace saved to %s, summary to %s.' % (peak_rss_bytes() / 1024 ** 2, trace_path, summary_path))
+
+
+def percentile(sorted_values, q):
+    index = min(len(sorted_values) - 1, int(round(q / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+profiler = Profiler()
@@ -0,0 +1,245 @@
+import io
+import sys
+import json
+import time
+import getopt
+import warnings
+import numpy as np
+import torch
+import torch.ao.quantization
+from Network import TOFlow
+from read_data import MemoryFriendlyLoader, PackedLoader, to_float
+from metrics import MetricLog
+from model_package import load_model, save_package
+
+# the convolutions of ResNet.ResBlock for every task, and whether a ReLU follows them
+resnet_layers = {
+    'interp': [('conv_3x2_64_9x9', True), ('conv_64_64_1x1', True), ('conv_64_3_1x1', False)],
+    'denoise': [('conv_3x7_64_9x9', True), ('conv_64_64_1x1', True), ('conv_64_3_1x1', False)],
+    'sr': [('conv_3x7_64_9x9', True), ('conv_64_64_9x9', True), ('conv_64_64_1x1', True), ('conv_64_3_1x1', False)],
+}
+resnet_layers['denoising'] = resnet_layers['denoise']
+resnet_layers['super-resolution'] = resnet_layers['sr']
+
+
+class QuantizedStack(torch.nn.Module):
+    """
+    Runs the convolutions of body in int8: the float input is quantized on entry and the output
+    dequantized on exit, so the warping and the flow accumulation around it stay in float.
+    """
+    def __init__(self, body):
+        super(QuantizedStack, self).__init__()
+        self.quant = torch.ao.quantization.QuantStub()
+        self.body = body
+        self.dequant = torch.ao.quantization.DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.body(self.quant(x)))
+
+
+def default_backend():
+    engines = torch.backends.quantized.supported_engines
+    for backend in ['x86', 'fbgemm', 'qnnpack']:
+        if backend in engines:
+            return backend
+    raise RuntimeError('This build of PyTorch supports no quantized engine.')
+
+
+def prepare_int8(net, backend):
+    """
+    Wrap every SpyNet.Basic conv sequence and the ResNet convolutions of net.task into QuantizedStack,
+    with the ReLUs fused into the convolutions, and insert the observers of backend.
+    :param net: a float TOFlow in eval mode, modified in place
+    """
+    torch.backends.quantized.engine = backend
+    qconfig = torch.ao.quantization.get_default_qconfig(backend)
+    stacks = []
+    for basic in net.SpyNet.moduleBasic:
+        # Conv2d, ReLU, ..., Conv2d: fuse every Conv2d with the ReLU after it
+        pairs = [[str(i), str(i + 1)] for i in range(0, len(basic.moduleBasic) - 1, 2)]
+        basic.moduleBasic = QuantizedStack(torch.ao.quantization.fuse_modules(basic.moduleBasic, pairs))
+        stacks.append(basic.moduleBasic)
+    for name, relu in resnet_layers[net.task]:
+        conv = getattr(net.ResNet, name)
+        if relu:
+            # ResBlock applies F.relu again, which is a no-op on the fused output
+            body = torch.ao.quantization.fuse_modules(torch.nn.Sequential(conv, torch.nn.ReLU()), [['0', '1']])
+        else:
+            body = conv
+        setattr(net.ResNet, name, QuantizedStack(body))
+        stacks.append(getattr(net.ResNet, name))
+    for stack in stacks:
+        stack.qconfig = qconfig
+    torch.ao.quantization.prepare(net, inplace=True)
+    return net
+
+
+def calibrate(net, dataset, indices, batch_size=1):
+    """run the samples indices of dataset through net, so that its observers record the activation ranges"""
+    loader = torch.utils.data.DataLoader(torch.utils.data.Subset(dataset, indices), batch_size=batch_size)
+    for i, (frames, _, _) in enumerate(loader):
+        net.inference(to_float(frames))
+        print('Calibrated %d/%d sequences.' % (min((i + 1) * batch_size, len(indices)), len(indices)))
+
+
+def quantize_toflow(net, dataset, indices, backend=None, batch_size=1):
+    """
+    Post-training int8 quantization of net, calibrated on the samples indices of dataset.
+    :return: the quantized TOFlow, on CPU. net is modified in place.
+    """
+    backend = backend or default_backend()
+    net.cpu().eval()
+    prepare_int8(net, backend)
+    calibrate(net, dataset, indices, batch_size)
+    torch.ao.quantization.convert(net, inplace=True)
+    net.backend = backend
+    return net
+
+
+def load_int8_toflow(state_dict, h, w, task, backend):
+    """:return: the quantized TOFlow of the state dict of a quantized TOFlow, in eval mode on CPU"""
+    net = TOFlow(h, w, task=task, cuda_flag=False, pretrained=False).eval()
+    prepare_int8(net, backend)
+    with warnings.catch_warnings():
+        # the observers are empty, the quantization parameters come from the state dict
+        warnings.simplefilter('ignore', UserWarning)
+        torch.ao.quantization.convert(net, inplace=True)
+    net.load_state_dict(state_dict)
+    net.backend = backend
+    return net
+
+
+def state_dict_bytes(net):
+    buffer = io.BytesIO()
+    torch.save(net.state_dict(), buffer)
+    return buffer.tell()
+
+
+def compare_models(nets, dataset, indices):
+    """
+    :param nets: {name: TOFlow}
+    :return: {name: {'psnr', 'ssim', 'abs', 'ms_per_sequence', 'model_bytes'}} on the samples indices of dataset
+    """
+    logs = dict((name, MetricLog()) for name in nets)
+    seconds = dict((name, 0.0) for name in nets)
+    for index in indices:
+        frames, ground_truth, code = dataset[index]
+        frames = to_float(frames).unsqueeze(0)
+        ground_truth = to_float(ground_truth).unsqueeze(0)
+        for name, net in nets.items():
+            start = time.perf_counter()
+            predicted = net.inference(frames)
+            seconds[name] += time.perf_counter() - start
+            logs[name].update([code], predicted, ground_truth)
+    report = {}
+    for name, net in nets.items():
+        report[name] = logs[name].summary()
+        report[name]['ms_per_sequence'] = seconds[name] / len(indices) * 1000
+        report[name]['model_bytes'] = state_dict_bytes(net)
+    return report
+
+
+if __name__ == '__main__':
+    task = ''
+    dataset_dir = ''
+    edited_img_dir = ''
+    pathlistfile = ''
+    pack_dir = ''
+    model_path = ''
+    out_path = ''
+    n_calibration = 32
+    n_evaluation = 16
+    backend = None
+    threads = None
+    seed = 0
+
+    if len(sys.argv) < 2 or sys.argv[1] in ['-h', '--help']:
+        print("""pytoflow version 1.1
+usage: python3 quantize.py [[option] [value]]...
+options:
+--task         the task of the model, like interp, denoising, super-resolution
+               valid values:[interp, denoise, denoising, sr, super-resolution]
+--dataDir      the directory of the image dataset(Vimeo-90K)
+--ex_dataDir   the directory of the preprocessed image dataset, for example, the Vimeo-90K mixed by Gaussian noise.
+--pathlist     the text file records which are the sequences to calibrate and evaluate on.
+--packDir      read the sequences from a dataset packed by pack_data.py instead.
+--model        the path of the float toflow model.
+--out          the path of the int8 model package to write.
+--calibration  the number of sequences to calibrate on. default: 32
+--evaluation   the number of other sequences to measure the quality loss and latency on. default: 16
+--backend      the quantized engine, one of %s. default: %s
+--threads      the number of intra-op threads while measuring. default: all
+--seed         the seed of the sequence sampling. default: 0
+-h, --help     get help.""" % (', '.join(torch.backends.quantized.supported_engines), default_backend()))
+        exit(0)
+
+    for strOption, strArgument in getopt.getopt(sys.argv[1:], '', [strParameter[2:] + '=' for strParameter in sys.argv[1::2]])[0]:
+        if strOption == '--task':
+            task = strArgument
+        elif strOption == '--dataDir':
+            dataset_dir = strArgument
+        elif strOption == '--ex_dataDir':
+            edited_img_dir = strArgument
+        elif strOption == '--pathlist':
+            pathlistfile = strArgument
+        elif strOption == '--packDir':
+            pack_dir = strArgument
+        elif strOption == '--model':
+            model_path = strArgument
+        elif strOption == '--out':
+            out_path = strArgument
+        elif strOption == '--calibration':
+            n_calibration = int(strArgument)
+        elif strOption == '--evaluation':
+            n_evaluation = int(strArgument)
+        elif strOption == '--backend':
+            backend = strArgument
+        elif strOption == '--threads':
+            threads = int(strArgument)
+        elif strOption == '--seed':
+            seed = int(strArgument)
+
+    if task not in ['interp', 'denoise', 'denoising', 'sr', 'super-resolution']:
+        raise ValueError('Invalid [--task].\nOnly support: [interp, denoise/denoising, sr/super-resolution]')
+    if pack_dir == '' and (dataset_dir == '' or pathlistfile == ''):
+        raise ValueError('Missing [--dataDir and --pathlist, or --packDir].\nPlease provide the calibration sequences.')
+    if model_path == '' or out_path == '':
+        raise ValueError('Missing [--model or --out].\nPlease provide the float model and the path of the int8 model.')
+    if backend != None and backend not in torch.backends.quantized.supported_engines:
+        raise ValueError('Invalid [--backend].\nOnly support: [%s]' % ', '.join(torch.backends.quantized.supported_engines))
+    if threads != None:
+        torch.set_num_threads(threads)
+
+    if pack_dir:
+        Dataset = PackedLoader(pack_dir, task=task)
+    else:
+        Dataset = MemoryFriendlyLoader(origin_img_dir=dataset_dir, edited_img_dir=edited_img_dir,
+                                       pathlistfile=pathlistfile, task=task)
+    indices = np.random.RandomState(seed).permutation(len(Dataset)).tolist()
+    calibration_indices = indices[:n_calibration]
+    # measure on held-out sequences if the pathlist has enough of them
+    evaluation_indices = indices[n_calibration:n_calibration + n_evaluation] or indices[:n_evaluation]
+
+    height, width = Dataset[0][0].shape[2:]
+    float_net = load_model(model_path, height, width, task, precision='fp32')
+    int8_net = load_model(model_path, height, width, task, precision='fp32')
+    quantize_toflow(int8_net, Dataset, calibration_indices, backend=backend)
+    save_package(int8_net, out_path)
+    print('int8 model saved to %s.' % out_path)
+
+    report = compare_models({'fp32': float_net, 'int8': int8_net}, Dataset, evaluation_indices)
+    report['psnr_delta'] = report['int8']['psnr'] - report['fp32']['psnr']
+    report['ssim_delta'] = report['int8']['ssim'] - report['fp32']['ssim']
+    report['speedup'] = report['fp32']['ms_per_sequence'] / report['int8']['ms_per_sequence']
+    report['calibration'] = [Dataset.pathlist[i] for i in calibration_indices]
+    report['evaluation'] = [Dataset.pathlist[i] for i in evaluation_indices]
+    report_path = out_path + '.json'
+    with open(report_path, 'w') as fp:
+        json.dump(report, fp, indent=2)
+
+    print('%-6s %9s %8s %14s %11s' % ('model', 'PSNR', 'SSIM', 'ms/sequence', 'size(MB)'))
+    for name in ['fp32', 'int8']:
+        print('%-6s %9.3f %8.4f %14.1f %11.1f' % (name, report[name]['psnr'], report[name]['ssim'],
+                                                   report[name]['ms_per_sequence'], report[name]['model_bytes'] / 1024 ** 2))
+    print('PSNR delta %+.3fdB, SSIM delta %+.4f, x%.2f faster on %d sequences. Report saved to %s.' %
+          (report['psnr_delta'], report['ssim_delta'], report['speedup'], len(evaluation_indices), report_path))
@@ -1,8 +1,15 @@
 import os
+import json
+import time
+import hashlib
 import numpy as np
+import PIL.Image
 import matplotlib.pyplot as plt
 import torch
 import torch.utils.data
+import torch.utils.data.distributed
+from profiling import profiler
+from Network import size_multiple
 
 class MemoryFriendlyLoader(torch.utils.data.Dataset):
     def __init__(self, origin_img_dir, pathlistfile, edited_img_dir='', task=''):
@@ -18,19 +25,23 @@ class MemoryFriendlyLoader(torch.utils.data.Dataset):
         fp.close()
         return pathlist
 
-    def __getitem__(self, index):
-        frames = []
+    def framepaths(self, index):
+        """:return: the paths of the input frames followed by the ground truth, and the number of input frames"""
         path_code = self.pathlist[index]
         if self.task == 'interp':
             N = 2   # 这里的N仅仅是为了下面取framex方便, 并非是论文里的N
-            for i in [1, 3]:
-                frames.append(plt.imread(os.path.join(self.origin_img_dir, path_code, 'im%d.png' % i)))                  # load the first and third images
-            frames.append(plt.imread(os.path.join(self.origin_img_dir, path_code, 'im2.png')))                           # load ground truth (the second one)
+            paths = [os.path.join(self.origin_img_dir, path_code, 'im%d.png' % i) for i in [1, 3]]          # the first and third images
+            paths.append(os.path.join(self.origin_img_dir, path_code, 'im2.png'))                           # ground truth (the second one)
         else:
             N = 7
-            for i in range(7):
-                frames.append(plt.imread(os.path.join(self.edited_img_dir, path_code, 'im%04d.png' % (i + 1))))          # load images with noise.
-            frames.append(plt.imread(os.path.join(self.origin_img_dir, path_code, 'im4.png')))                           # load ground truth
+            paths = [os.path.join(self.edited_img_dir, path_code, 'im%04d.png' % (i + 1)) for i in range(7)]  # images with noise.
+            paths.append(os.path.join(self.origin_img_dir, path_code, 'im4.png'))                           # ground truth
+        return paths, N
+
+    def __getitem__(self, index):
+        path_code = self.pathlist[index]
+        paths, N = self.framepaths(index)
+        frames = [plt.imread(path) for path in paths]
 
         frames = np.array(frames)
         framex = np.transpose(frames[0:N, :, :, :], (0, 3, 1, 2))
@@ -40,3 +51,346 @@ class MemoryFriendlyLoader(torch.utils.data.Dataset):
 
     def __len__(self):
         return self.count
+
+
+
+def get_process_index(task):
+    """:return: the numbers of the input frames of a test sequence of task, and the format of their file names"""
+    if task == 'interp':
+        process_index = [1, 3]
+        str_format = 'im%d.png'
+    elif task in ['interp', 'denoise', 'denoising', 'sr', 'super-resolution']:
+        process_index = [1, 2, 3, 4, 5, 6, 7]
+        str_format = 'im%04d.png'
+    else:
+        raise ValueError('Invalid [--task].\nOnly support: [interp, denoise/denoising, sr/super-resolution]')
+    return process_index, str_format
+
+
+@profiler.traced('evaluate.read')
+def read_sequence(input_dir, code, process_index, str_format):
+    """:return: input_frames: [img_num, n_channels=3, h, w], of a test sequence, see get_process_index"""
+    input_frames = []
+    for i in process_index:
+        input_frames.append(plt.imread(os.path.join(input_dir, code, str_format % i))[:, :, :3])
+    return np.transpose(np.array(input_frames), (0, 3, 1, 2))
+
+
+@profiler.traced('evaluate.read_gt')
+def read_ground_truth(gt_dir, code, task):
+    """:return: ground truth: [n_channels=3, h, w]"""
+    gt_name = 'im2.png' if task == 'interp' else 'im4.png'
+    return np.transpose(plt.imread(os.path.join(gt_dir, code, gt_name))[:, :, :3], (2, 0, 1))
+
+
+def to_float(tensor):
+    """uint8 frames of PackedLoader -> float frames in [0, 1], the same values as plt.imread of the PNGs"""
+    if tensor.dtype == torch.uint8:
+        return tensor.float().div_(255.0)
+    return tensor
+
+
+def pack_dataset(dataset, pack_dir, shard_bytes=4 * 1024 ** 3):
+    """
+    Decode every sample of a MemoryFriendlyLoader once and pack it into contiguous uint8 shards.
+    pack_dir/shard_%03d.bin holds the frames of the samples, (input frames + ground truth, h, w, 3) each,
+    and pack_dir/index.json records the shard, byte offset and shape of every path code.
+    """
+    if not os.path.exists(pack_dir):
+        os.makedirs(pack_dir)
+    index = {'task': dataset.task, 'shards': [], 'entries': []}
+    fp = None
+    for i in range(dataset.count):
+        paths, N = dataset.framepaths(i)
+        frames = np.stack([np.asarray(PIL.Image.open(path).convert('RGB')) for path in paths])
+        if fp is None or fp.tell() + frames.nbytes > shard_bytes:
+            if fp is not None:
+                fp.close()
+            index['shards'].append('shard_%03d.bin' % len(index['shards']))
+            fp = open(os.path.join(pack_dir, index['shards'][-1]), 'wb')
+        index['entries'].append({'path_code': dataset.pathlist[i], 'shard': len(index['shards']) - 1,
+                                 'offset': fp.tell(), 'shape': list(frames.shape), 'N': N})
+        fp.write(frames.tobytes())
+    if fp is not None:
+        fp.close()
+    with open(os.path.join(pack_dir, 'index.json'), 'w') as fp:
+        json.dump(index, fp)
+    return index
+
+
+class PackedLoader(torch.utils.data.Dataset):
+    """
+    MemoryFriendlyLoader over the shards written by pack_dataset.
+    The shards are memory-mapped and the samples are returned as uint8 tensor views of the mapping,
+    convert them with to_float after moving them to the device.
+    """
+    def __init__(self, pack_dir, task=''):
+        self.pack_dir = pack_dir
+        fp = open(os.path.join(pack_dir, 'index.json'))
+        index = json.load(fp)
+        fp.close()
+        aliases = {'denoising': 'denoise', 'super-resolution': 'sr'}
+        if task != '' and aliases.get(task, task) != aliases.get(index['task'], index['task']):
+            raise ValueError('%s is packed for [%s], not [%s].' % (pack_dir, index['task'], task))
+        self.task = index['task']
+        self.shardnames = index['shards']
+        self.entries = index['entries']
+        self.pathlist = [entry['path_code'] for entry in self.entries]
+        self.count = len(self.pathlist)
+        self.shards = None  # mapped lazily, so that every DataLoader worker maps the shards by itself
+
+    def __getitem__(self, index):
+        if self.shards is None:
+            # copy-on-write mappings are writable for torch.from_numpy but never copied unless written
+            self.shards = [np.memmap(os.path.join(self.pack_dir, name), dtype=np.uint8, mode='c') for name in self.shardnames]
+        entry = self.entries[index]
+        size = int(np.prod(entry['shape']))
+        frames = self.shards[entry['shard']][entry['offset']:entry['offset'] + size].reshape(entry['shape'])
+        frames = torch.from_numpy(frames).permute(0, 3, 1, 2)
+        N = entry['N']
+        return frames[0:N], frames[N], entry['path_code']
+
+    def __len__(self):
+        return self.count
+
+
+def state_fingerprint(module):
+    """the sha1 of the parameters and buffers of module, to tell whether what was computed with them is stale"""
+    digest = hashlib.sha1()
+    for name, tensor in sorted(module.state_dict().items()):
+        digest.update(name.encode())
+        digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return digest.hexdigest()
+
+
+def build_flow_cache(net, dataset, cache_dir, batch_size=1, rank=0, world_size=1):
+    """
+    Estimate the flows of every sample of dataset with net.estimate_flows once and store them in float16.
+    cache_dir/flows.bin holds a [count, pair_num, 2, padded_h, padded_w] array, and cache_dir/index.json
+    records its shape, the task, the path codes and the fingerprint of the SpyNet weights.
+    All the samples must have the same size.
+    With world_size processes, each one estimates its own contiguous part of the samples into a disjoint
+    slice of flows.bin, and the caller writes index.json with write_flow_cache_index once all are done.
+    :return: the index, only written here with a single process
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    index_path = os.path.join(cache_dir, 'index.json')
+    if rank == 0 and os.path.exists(index_path):
+        # the cache is incomplete until the index is written again
+        os.remove(index_path)
+    device = next(net.parameters()).device
+    # every process knows the shape beforehand, so each one can map the whole file
+    framex = dataset[0][0]
+    height, width = framex.size(-2), framex.size(-1)
+    shape = [dataset.count, len(net.flow_pairs()[0]), 2, height + -height % size_multiple, width + -width % size_multiple]
+    flows_path = os.path.join(cache_dir, 'flows.bin')
+    with open(flows_path, 'ab') as fp:
+        # every process sizes the file to the same length, none of them truncates the slice of another
+        fp.truncate(int(np.prod(shape)) * np.dtype(np.float16).itemsize)
+    flows = np.memmap(flows_path, dtype=np.float16, mode='r+', shape=tuple(shape))
+    first, last = dataset.count * rank // world_size, dataset.count * (rank + 1) // world_size
+    loader = torch.utils.data.DataLoader(torch.utils.data.Subset(dataset, range(first, last)), batch_size=batch_size)
+    start = first
+    for framex, _, path_code in loader:
+        batch = net.estimate_flows(to_float(framex.to(device)))
+        if list(batch.shape[1:]) != shape[1:]:
+            raise ValueError('The flow cache needs frames of one size, %s differs.' % path_code[0])
+        flows[start:start + len(path_code)] = batch.half().cpu().numpy()
+        start += len(path_code)
+        if rank == 0:
+            print('Estimated the flows of %d/%d samples%s.' %
+                  (start - first, last - first, '' if world_size == 1 else ' in each of %d processes' % world_size))
+    flows.flush()
+    del flows
+    index = {'task': dataset.task, 'pathlist': dataset.pathlist, 'shape': shape, 'spynet': state_fingerprint(net.SpyNet)}
+    if world_size == 1:
+        write_flow_cache_index(cache_dir, index)
+    return index
+
+
+def write_flow_cache_index(cache_dir, index):
+    """write the index of build_flow_cache once all the flows are in flows.bin"""
+    # written last, a cache without index.json is incomplete
+    with open(os.path.join(cache_dir, 'index.json'), 'w') as fp:
+        json.dump(index, fp)
+
+
+def flow_cache_matches(cache_dir, net, dataset):
+    """:return: whether cache_dir holds the flows of the SpyNet of net for the samples of dataset"""
+    index_path = os.path.join(cache_dir, 'index.json')
+    if not os.path.exists(index_path):
+        return False
+    with open(index_path) as fp:
+        index = json.load(fp)
+    return index['pathlist'] == dataset.pathlist and index['spynet'] == state_fingerprint(net.SpyNet)
+
+
+class CachedFlows(torch.utils.data.Dataset):
+    """
+    The samples of dataset together with their flows from the cache of build_flow_cache,
+    as (framex, framey, path_code, flows) with flows: [pair_num, 2, padded_h, padded_w] in float16.
+    The cache is only opened by the first sample, so it can be built after this dataset, and it is
+    memory-mapped like the shards of PackedLoader.
+    """
+    def __init__(self, dataset, cache_dir):
+        self.dataset = dataset
+        self.cache_dir = cache_dir
+        self.task = dataset.task
+        self.pathlist = dataset.pathlist
+        self.count = dataset.count
+        self.flows = None   # mapped lazily, in every DataLoader worker by itself
+
+    def __getitem__(self, index):
+        if self.flows is None:
+            with open(os.path.join(self.cache_dir, 'index.json')) as fp:
+                cache_index = json.load(fp)
+            if cache_index['pathlist'] != self.pathlist:
+                raise ValueError('The flow cache %s is for another pathlist.' % self.cache_dir)
+            self.flows = np.memmap(os.path.join(self.cache_dir, 'flows.bin'), dtype=np.float16, mode='c',
+                                   shape=tuple(cache_index['shape']))
+        framex, framey, path_code = self.dataset[index]
+        return framex, framey, path_code, torch.from_numpy(self.flows[index])
+
+    def __len__(self):
+        return self.count
+
+
+class RandomCrops(torch.utils.data.Dataset):
+    """
+    Random crops of the samples of a MemoryFriendlyLoader or PackedLoader. Every sample is decoded once
+    and gives crops_per_sample crops at independent random positions, each aligned across the input frames
+    and the ground truth, as framex: [crops_per_sample, N, 3, crop_h, crop_w], framey: [crops_per_sample, 3, crop_h, crop_w]
+    and a path code per crop. The flows of CachedFlows are cropped too. Batch them with collate_crops.
+    """
+    def __init__(self, dataset, crop_size, crops_per_sample=1):
+        """:param crop_size: (crop_h, crop_w)"""
+        self.dataset = dataset
+        self.crop_height, self.crop_width = crop_size
+        self.crops_per_sample = crops_per_sample
+        self.task = dataset.task
+        self.pathlist = dataset.pathlist
+        self.count = dataset.count
+
+    def __getitem__(self, index):
+        sample = self.dataset[index]
+        framex, framey, path_code = sample[:3]
+        height, width = framey.size(-2), framey.size(-1)
+        if self.crop_height > height or self.crop_width > width:
+            raise ValueError('The crop %dx%d is larger than the %dx%d frames of %s.' %
+                             (self.crop_height, self.crop_width, height, width, path_code))
+        # the torch generator is seeded differently in every DataLoader worker
+        tops = torch.randint(0, height - self.crop_height + 1, (self.crops_per_sample,)).tolist()
+        lefts = torch.randint(0, width - self.crop_width + 1, (self.crops_per_sample,)).tolist()
+        # framex, framey and the flows of CachedFlows all end with the h and w dimensions
+        crops = [torch.stack([tensor[..., top:top + self.crop_height, left:left + self.crop_width] for top, left in zip(tops, lefts)])
+                 for tensor in (framex, framey) + tuple(sample[3:])]
+        return (crops[0], crops[1], [path_code] * self.crops_per_sample) + tuple(crops[2:])
+
+    def __len__(self):
+        return self.count
+
+
+def collate_crops(samples):
+    """
+    Batch the crops of several RandomCrops samples together, in random order so that the crops
+    of one sample are spread over the batches of split_batches.
+    """
+    path_code = [code for sample in samples for code in sample[2]]
+    order = torch.randperm(len(path_code))
+    tensors = [torch.cat([sample[k] for sample in samples])[order] for k in range(len(samples[0])) if k != 2]
+    return (tensors[0], tensors[1], [path_code[i] for i in order.tolist()]) + tuple(tensors[2:])
+
+
+def split_batches(batches, batch_size):
+    """split every (framex, framey, path_code[, flows]) batch into batches of at most batch_size samples"""
+    for batch in batches:
+        for start in range(0, len(batch[2]), batch_size):
+            yield tuple(item[start:start + batch_size] for item in batch)
+
+
+class ResumableSampler(torch.utils.data.distributed.DistributedSampler):
+    """
+    DistributedSampler whose next epoch can start part way through, skipping the samples trained on
+    before a checkpoint. The order of every epoch only depends on seed and the epoch, so it is the same
+    after resuming. Without num_replicas and rank, it samples the whole dataset in one process.
+    """
+    def __init__(self, dataset, num_replicas=1, rank=0, shuffle=True, seed=0):
+        super(ResumableSampler, self).__init__(dataset, num_replicas=num_replicas, rank=rank, shuffle=shuffle, seed=seed)
+        self.start = 0
+
+    def set_position(self, epoch, start):
+        """:param start: the number of samples of epoch to skip, in this process"""
+        self.set_epoch(epoch)
+        self.start = start
+
+    def __iter__(self):
+        indices = list(super(ResumableSampler, self).__iter__())[self.start:]
+        # only the resumed epoch is shortened
+        self.start = 0
+        return iter(indices)
+
+    def __len__(self):
+        return self.num_samples - self.start
+
+
+def make_loader(dataset, batch_size=1, shuffle=True, num_workers=0, prefetch=2, pin_memory=False, sampler=None,
+                generator=None):
+    """
+    DataLoader decoding the samples in num_workers worker processes. Every worker keeps at most
+    prefetch batches ready, and pin_memory stages the batches in page-locked memory for fast
+    non-blocking copies to the GPU. The batches of RandomCrops hold batch_size * crops_per_sample crops.
+    :param generator: the torch generator the seeds of the workers are drawn from, instead of the global one
+    """
+    kwargs = {}
+    if num_workers > 0:
+        kwargs['prefetch_factor'] = prefetch
+        kwargs['persistent_workers'] = True
+    if isinstance(dataset, RandomCrops):
+        kwargs['collate_fn'] = collate_crops
+    return torch.utils.data.DataLoader(dataset=dataset, batch_size=batch_size, shuffle=shuffle and sampler is None,
+                                       sampler=sampler, num_workers=num_workers, pin_memory=pin_memory,
+                                       generator=generator, **kwargs)
+
+
+class TimedLoader(object):
+    """
+    Iterate over (framex, framey, path_code[, flows]) batches of a DataLoader, move them to device as float
+    frames and measure how long the training loop waits for every batch.
+    """
+    def __init__(self, loader, device=None):
+        self.loader = loader
+        self.device = device
+        self.last_wait = 0.0     # seconds waited for the last batch
+        self.total_wait = 0.0    # seconds waited in the current epoch
+        self.steps = 0
+        self.fetched = 0         # samples, or crops, fetched in the current epoch
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.total_wait = 0.0
+        self.steps = 0
+        self.fetched = 0
+        iterator = iter(self.loader)
+        while True:
+            start = time.perf_counter()
+            with profiler.span('data.wait'):
+                try:
+                    batch = next(iterator)
+                except StopIteration:
+                    return
+                framex, framey, path_code = batch[:3]
+                # the float16 flows of CachedFlows
+                flows = list(batch[3:])
+                if self.device is not None:
+                    framex = framex.to(self.device, non_blocking=True)
+                    framey = framey.to(self.device, non_blocking=True)
+                    flows = [tensor.to(self.device, non_blocking=True) for tensor in flows]
+                framex, framey = to_float(framex), to_float(framey)
+                flows = [tensor.float() for tensor in flows]
+            self.last_wait = time.perf_counter() - start
+            self.total_wait += self.last_wait
+            self.steps += 1
+            self.fetched += len(path_code)
+            yield (framex, framey, path_code) + tuple(flows)
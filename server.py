@@ -0,0 +1,329 @@
+import io
+import sys
+import json
+import time
+import getopt
+import threading
+import collections
+import concurrent.futures
+import http.server
+import numpy as np
+import torch
+from model_package import load_model
+from profiling import percentile
+
+img_nums = {'interp': 2, 'denoise': 7, 'sr': 7}
+task_aliases = {'denoising': 'denoise', 'super-resolution': 'sr'}
+
+
+def encode_array(array):
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=False)
+    return buffer.getvalue()
+
+
+def decode_array(data):
+    return np.load(io.BytesIO(data), allow_pickle=False)
+
+
+class Request(object):
+    def __init__(self, frames):
+        self.frames = frames
+        self.arrival = time.perf_counter()
+        self.future = concurrent.futures.Future()
+
+
+class ServerMetrics(object):
+    """counters and the latencies of the last window requests of every task"""
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.window = window
+        self.counters = collections.defaultdict(int)
+        self.samples = collections.defaultdict(lambda: collections.deque(maxlen=self.window))
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def sample(self, name, value):
+        with self.lock:
+            self.samples[name].append(value)
+
+    def snapshot(self):
+        with self.lock:
+            report = {'counters': dict(self.counters), 'latency_ms': {}, 'batch_size': {}}
+            for name, values in self.samples.items():
+                values = sorted(values)
+                if not values:
+                    continue
+                stats = {'count': len(values), 'mean': sum(values) / len(values), 'p50': percentile(values, 50),
+                         'p90': percentile(values, 90), 'p99': percentile(values, 99), 'max': values[-1]}
+                if name.endswith('.batch_size'):
+                    report['batch_size'][name[:-len('.batch_size')]] = stats
+                else:
+                    report['latency_ms'][name] = stats
+        return report
+
+
+class DynamicBatcher(object):
+    """
+    Queue the frame windows of one warm TOFlow and run them in batches of the same shape.
+    A batch is started once max_batch windows of a shape are queued, or once the oldest of them
+    has waited max_delay seconds.
+    """
+    def __init__(self, task, net, metrics, max_batch=8, max_delay=0.01):
+        self.task = task
+        self.net = net
+        self.metrics = metrics
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.pending = collections.OrderedDict()    # shape -> [Request]
+        self.depth = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name='batcher-' + task, daemon=True)
+        self.thread.start()
+
+    def submit(self, frames):
+        """
+        :param frames: [img_num, n_channels=3, h, w] float tensor
+        :return: a Future of the [n_channels=3, h, w] prediction
+        """
+        request = Request(frames)
+        with self.condition:
+            if self.closed:
+                raise RuntimeError('The %s batcher is closed.' % self.task)
+            self.pending.setdefault(tuple(frames.shape), []).append(request)
+            self.depth += 1
+            self.condition.notify()
+        return request.future
+
+    def next_batch(self):
+        """wait for a full or overdue shape, and take its requests. :return: the requests, or None once closed"""
+        with self.condition:
+            while True:
+                if self.closed:
+                    return None
+                now = time.perf_counter()
+                deadline = None
+                for shape, requests in self.pending.items():
+                    due = requests[0].arrival + self.max_delay
+                    if len(requests) >= self.max_batch or due <= now:
+                        batch = requests[:self.max_batch]
+                        del requests[:self.max_batch]
+                        if not requests:
+                            del self.pending[shape]
+                        self.depth -= len(batch)
+                        return batch
+                    deadline = due if deadline is None else min(deadline, due)
+                self.condition.wait(None if deadline is None else deadline - now)
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                return
+            start = time.perf_counter()
+            try:
+                predicted = self.net.inference(torch.stack([request.frames for request in batch]))
+            except Exception as error:
+                for request in batch:
+                    request.future.set_exception(error)
+                continue
+            end = time.perf_counter()
+            self.metrics.count(self.task + '.batches')
+            self.metrics.sample(self.task + '.batch_size', len(batch))
+            self.metrics.sample(self.task + '.forward', (end - start) * 1000)
+            for k, request in enumerate(batch):
+                self.metrics.sample(self.task + '.queue', (start - request.arrival) * 1000)
+                request.future.set_result(predicted[k])
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+
+
+class ModelPool(object):
+    """a warm TOFlow and its DynamicBatcher per task"""
+    def __init__(self, model_paths, cuda_flag=False, precision=None, max_batch=8, max_delay=0.01, warmup_size=None):
+        """
+        :param model_paths: {task: the path of its model}
+        :param warmup_size: (h, w) of a dummy batch run through every model before serving
+        """
+        self.metrics = ServerMetrics()
+        self.cuda_flag = cuda_flag
+        self.batchers = {}
+        for task, model_path in model_paths.items():
+            net = load_model(model_path, None, None, task, cuda_flag=cuda_flag, precision=precision)
+            if warmup_size != None:
+                frames = torch.zeros(max_batch, img_nums[task], 3, warmup_size[0], warmup_size[1])
+                net.inference(frames.cuda() if cuda_flag else frames)
+            self.batchers[task] = DynamicBatcher(task, net, self.metrics, max_batch=max_batch, max_delay=max_delay)
+
+    def enhance(self, task, frames):
+        """
+        :param frames: [img_num, h, w, n_channels=3] uint8 array
+        :return: [h, w, n_channels=3] uint8 array
+        """
+        batcher = self.batchers[task]
+        tensor = torch.from_numpy(frames).permute(0, 3, 1, 2)
+        if self.cuda_flag:
+            tensor = tensor.cuda()
+        predicted = batcher.submit(tensor.float().div_(255.0)).result()
+        return predicted.clamp(0, 1).mul(255.0).round_().byte().permute(1, 2, 0).cpu().numpy()
+
+    def report(self):
+        report = self.metrics.snapshot()
+        report['queue_depth'] = dict((task, batcher.depth) for task, batcher in self.batchers.items())
+        return report
+
+    def close(self):
+        for batcher in self.batchers.values():
+            batcher.close()
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """
+    POST /enhance/<task> with an .npy body of [img_num, h, w, 3] uint8 frames returns the .npy of the [h, w, 3] output.
+    GET /metrics returns the queue depth, batch size and latency statistics as JSON.
+    """
+    protocol_version = 'HTTP/1.1'
+    pool = None
+
+    def send(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, status, message):
+        self.send(status, json.dumps({'error': message}).encode(), 'application/json')
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self.send(200, json.dumps(self.pool.report(), indent=2).encode(), 'application/json')
+        elif self.path == '/health':
+            self.send(200, json.dumps({'tasks': sorted(self.pool.batchers)}).encode(), 'application/json')
+        else:
+            self.send_error_json(404, 'Unknown path %s.' % self.path)
+
+    def do_POST(self):
+        start = time.perf_counter()
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if not self.path.startswith('/enhance/'):
+            self.send_error_json(404, 'Unknown path %s.' % self.path)
+            return
+        task = task_aliases.get(self.path[len('/enhance/'):], self.path[len('/enhance/'):])
+        if task not in self.pool.batchers:
+            self.send_error_json(404, 'No model is loaded for [%s].' % task)
+            return
+        try:
+            frames = decode_array(body)
+        except Exception as error:
+            # np.load raises ValueError, EOFError or OSError on an empty, truncated or malformed body
+            self.send_error_json(400, 'Invalid .npy body: %s' % (str(error) or type(error).__name__))
+            return
+        if frames.dtype != np.uint8 or frames.ndim != 4 or frames.shape[0] != img_nums[task] or frames.shape[3] != 3:
+            self.send_error_json(400, '[%s] takes uint8 frames of shape [%d, h, w, 3], got %s %s.' %
+                                 (task, img_nums[task], frames.dtype, list(frames.shape)))
+            return
+        self.pool.metrics.count(task + '.requests')
+        try:
+            predicted = self.pool.enhance(task, frames)
+        except Exception as error:
+            self.pool.metrics.count(task + '.errors')
+            self.send_error_json(500, '[%s] failed: %s: %s' % (task, type(error).__name__, error))
+            return
+        self.send(200, encode_array(predicted), 'application/octet-stream')
+        self.pool.metrics.sample(task + '.total', (time.perf_counter() - start) * 1000)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(pool, host='127.0.0.1', port=8080):
+    Handler.pool = pool
+    httpd = http.server.ThreadingHTTPServer((host, port), Handler)
+    httpd.daemon_threads = True
+    return httpd
+
+
+if __name__ == '__main__':
+    model_paths = {}
+    host = '127.0.0.1'
+    port = 8080
+    gpuID = None
+    precision = None
+    max_batch = 8
+    max_delay = 10      # ms
+    warmup_size = None
+    threads = None
+
+    if len(sys.argv) < 2 or sys.argv[1] in ['-h', '--help']:
+        print("""pytoflow version 1.1
+usage: python3 server.py [[option] [value]]...
+options:
+--interp       the path of the interp model to serve.
+--denoise      the path of the denoising model to serve.
+--sr           the path of the super-resolution model to serve.
+--host         the address to listen on. default: 127.0.0.1
+--port         the port to listen on. default: 8080
+--maxBatch     the largest number of frame windows per forward pass. default: 8
+--maxDelay     the longest time (ms) a frame window waits for a batch to fill. default: 10
+--warmup       run a dummy batch of this size through every model before serving, like 256x448.
+--precision    fp32 or bf16. default: the precision of the model packages, or fp32
+--threads      the number of intra-op threads. default: all
+--gpuID        the No. of the GPU you want to use. default: no gpu.
+-h, --help     get help.
+endpoints:
+POST /enhance/<task>   an .npy body of [img_num, h, w, 3] uint8 frames -> the .npy of the [h, w, 3] uint8 output
+GET  /metrics          queue depth, batch sizes and latencies as JSON""")
+        exit(0)
+
+    for strOption, strArgument in getopt.getopt(sys.argv[1:], '', [strParameter[2:] + '=' for strParameter in sys.argv[1::2]])[0]:
+        if strOption in ['--interp', '--denoise', '--sr']:
+            model_paths[strOption[2:]] = strArgument
+        elif strOption == '--host':
+            host = strArgument
+        elif strOption == '--port':
+            port = int(strArgument)
+        elif strOption == '--maxBatch':
+            max_batch = int(strArgument)
+        elif strOption == '--maxDelay':
+            max_delay = float(strArgument)
+        elif strOption == '--warmup':
+            warmup_size = tuple(int(x) for x in strArgument.split('x'))
+        elif strOption == '--precision':
+            precision = strArgument
+        elif strOption == '--threads':
+            threads = int(strArgument)
+        elif strOption == '--gpuID':
+            gpuID = int(strArgument)
+
+    if not model_paths:
+        raise ValueError('Missing [--interp, --denoise or --sr].\nPlease provide the path of at least one model.')
+    if precision not in [None, 'fp32', 'bf16']:
+        raise ValueError('Invalid [--precision].\nOnly support: [fp32, bf16]')
+
+    if gpuID == None:
+        cuda_flag = False
+    else:
+        cuda_flag = True
+        torch.cuda.set_device(gpuID)
+    if threads != None:
+        torch.set_num_threads(threads)
+
+    pool = ModelPool(model_paths, cuda_flag=cuda_flag, precision=precision, max_batch=max_batch,
+                     max_delay=max_delay / 1000.0, warmup_size=warmup_size)
+    httpd = serve(pool, host, port)
+    print('Serving [%s] on http://%s:%d' % (', '.join(sorted(model_paths)), host, port))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        pool.close()
@@ -0,0 +1,281 @@
+import sys
+import getopt
+import datetime
+import subprocess
+import collections
+import numpy as np
+import torch
+import cv2
+from model_package import load_model
+from tiling import TiledTOFlow
+
+
+def probe_video(video_name):
+    """
+    :return: width, height, fps of the video
+    """
+    cap = cv2.VideoCapture(video_name)
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    cap.release()
+    if width == 0 or height == 0:
+        raise RuntimeError('Cannot open video %s.' % video_name)
+    return width, height, fps
+
+
+class FrameReader(object):
+    """
+    Decode a video with an ffmpeg pipe, frame by frame, into reused uint8 buffers of shape (height, width, 3).
+    A frame returned by read() stays valid for the next n_buffers - 1 calls.
+    """
+    def __init__(self, video_name, width, height, n_buffers=8):
+        self.width = width
+        self.height = height
+        self.frame_bytes = width * height * 3
+        self.buffers = [np.empty((height, width, 3), dtype=np.uint8) for _ in range(n_buffers)]
+        self.next_buffer = 0
+        command = ['ffmpeg', '-v', 'error', '-i', video_name, '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-']
+        self.process = subprocess.Popen(command, stdout=subprocess.PIPE, bufsize=self.frame_bytes)
+
+    def read(self):
+        """:return: the next frame, or None at the end of the video"""
+        buffer = self.buffers[self.next_buffer]
+        view = memoryview(buffer.reshape(-1))
+        received = 0
+        while received < self.frame_bytes:
+            n = self.process.stdout.readinto(view[received:])
+            if not n:
+                return None
+            received += n
+        self.next_buffer = (self.next_buffer + 1) % len(self.buffers)
+        return buffer
+
+    def close(self):
+        self.process.stdout.close()
+        if self.process.wait():
+            raise RuntimeError('Cannot decode frames with ffmpeg.')
+
+
+class FrameWriter(object):
+    """
+    Encode uint8 frames of shape (height, width, 3) with an ffmpeg pipe.
+    The audio of audio_source is copied into the output if provided.
+    """
+    def __init__(self, output_video, width, height, fps, audio_source=None, qscale=2):
+        command = ['ffmpeg', '-y', '-v', 'error',
+                   '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', '%dx%d' % (width, height), '-r', '%f' % fps, '-i', '-']
+        if audio_source != None:
+            command += ['-i', audio_source, '-map', '0:v', '-map', '1:a?', '-c:a', 'copy', '-shortest']
+        command += ['-q:v', str(qscale), '-pix_fmt', 'yuv420p', output_video]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    def write(self, frame):
+        self.process.stdin.write(np.ascontiguousarray(frame).data)
+
+    def close(self):
+        self.process.stdin.close()
+        if self.process.wait():
+            raise RuntimeError('Cannot encode frames with ffmpeg.')
+
+
+def to_tensor(frame, cuda_flag=False):
+    """(height, width, 3) uint8 -> [3, height, width] float in [0, 1]"""
+    tensor = torch.from_numpy(frame).permute(2, 0, 1)
+    if cuda_flag:
+        tensor = tensor.cuda()
+    return tensor.float().div_(255.0)
+
+
+def to_frame(tensor):
+    """[3, height, width] float in [0, 1] -> (height, width, 3) uint8"""
+    return tensor.clamp(0, 1).mul(255.0).round_().byte().permute(1, 2, 0).cpu().numpy()
+
+
+def sliding_windows(reader, task, cuda_flag=False):
+    """
+    Yield the input windows of TOFlow and the frames to write before each of their outputs.
+    denoise/sr: windows of 7 frames centered on every frame, the borders are replicated.
+    interp: windows of every 2 consecutive frames, the first frame is written before the interpolated one.
+    """
+    if task == 'interp':
+        previous = None
+        while True:
+            frame = reader.read()
+            if frame is None:
+                break
+            current = to_tensor(frame, cuda_flag)
+            if previous is not None:
+                yield torch.stack([previous, current]), [previous]
+            previous = current
+        if previous is not None:
+            yield None, [previous]
+    else:
+        window = collections.deque(maxlen=7)
+        frame = reader.read()
+        if frame is None:
+            return
+        first = to_tensor(frame, cuda_flag)
+        window.extend([first] * 4)
+        while True:
+            frame = reader.read()
+            if frame is None:
+                break
+            window.append(to_tensor(frame, cuda_flag))
+            if len(window) == 7:
+                yield torch.stack(list(window)), []
+        # the last 3 frames, replicating the last frame
+        last = window[-1]
+        for _ in range(3):
+            window.append(last)
+            if len(window) == 7:
+                yield torch.stack(list(window)), []
+
+
+def enhance_stream(engine, task, reader, writer, batch_size=1, cuda_flag=False):
+    """
+    Stream frames from reader through engine into writer, keeping only a sliding window in memory.
+    :param engine: TOFlow.inference, a TiledTOFlow, or the engine of slow_motion returning several frames per window
+    :return: the number of written frames
+    """
+    pending = []    # (window, frames to write before its output)
+    written = 0
+
+    def flush():
+        count = 0
+        windows = [window for window, _ in pending if window is not None]
+        predictions = engine(torch.stack(windows)) if windows else []
+        k = 0
+        for window, before in pending:
+            for frame in before:
+                writer.write(to_frame(frame))
+                count += 1
+            if window is not None:
+                # [n_channels=3, h, w], or [timesteps, n_channels=3, h, w] for slow_motion
+                outputs = predictions[k] if predictions[k].dim() == 4 else [predictions[k]]
+                for output in outputs:
+                    writer.write(to_frame(output))
+                    count += 1
+                k += 1
+        del pending[:]
+        return count
+
+    for window, before in sliding_windows(reader, task, cuda_flag):
+        pending.append((window, before))
+        if len(pending) >= batch_size:
+            written += flush()
+    written += flush()
+    return written
+
+
+def slow_motion(net, factor):
+    """
+    :return: an engine synthesizing the factor - 1 frames between the 2 frames of every interp window
+             with TOFlow.interpolate, which estimates the flows of a window only once
+    """
+    timesteps = [k / float(factor) for k in range(1, factor)]
+
+    def engine(windows):
+        with torch.no_grad():
+            return net.interpolate(windows[:, 0], windows[:, 1], timesteps)
+    return engine
+
+
+def enhance_video(video_name, output_video, net, batch_size=1, memory_budget=None, keep_audio=False, cuda_flag=False,
+                  slowmo=2):
+    """:param slowmo: interp writes slowmo - 1 frames between every 2 frames, at slowmo times the frame rate"""
+    width, height, fps = probe_video(video_name)
+    if net.task == 'interp' and slowmo != 2:
+        if memory_budget != None:
+            raise ValueError('Tiled inference only interpolates the middle frame, remove [--memory] or [--slowmo].')
+        engine = slow_motion(net, slowmo)
+    elif memory_budget != None:
+        engine = TiledTOFlow(net, memory_budget=memory_budget)
+    else:
+        engine = net.inference
+    out_fps = fps * slowmo if net.task == 'interp' else fps
+
+    reader = FrameReader(video_name, width, height)
+    writer = FrameWriter(output_video, width, height, out_fps, audio_source=video_name if keep_audio else None)
+    try:
+        count = enhance_stream(engine, net.task, reader, writer, batch_size=batch_size, cuda_flag=cuda_flag)
+    finally:
+        # stop the decoder even if the encoder fails
+        try:
+            writer.close()
+        finally:
+            reader.close()
+    return count
+
+
+if __name__ == '__main__':
+    task = ''
+    model_path = ''
+    video_name = ''
+    output_video = ''
+    gpuID = None
+    batch_size = 1
+    memory_budget = None
+    keep_audio = False
+    slowmo = 2
+
+    if len(sys.argv) < 2 or sys.argv[1] in ['-h', '--help']:
+        print("""pytoflow version 1.1
+usage: python3 stream.py [[option] [value]]...
+options:
+--task         the task of the model, like interp, denoising, super-resolution
+               valid values:[interp, denoise, denoising, sr, super-resolution]
+--model        the path of the model used, saved by train.py or a model package.
+--vn           the path of the input video.
+--ov           the path of the output video.
+--batchSize    the number of frame windows per forward pass. default: 1
+--memory       memory budget (MB) of tiled inference. default: no tiling.
+--audio        copy the audio of the input video. default: False
+--slowmo       interp: the factor of the frame rate, slowmo - 1 frames are synthesized between every 2 frames. default: 2
+--gpuID        the No. of the GPU you want to use. default: no gpu.
+-h, --help     get help.""")
+        exit(0)
+
+    for strOption, strArgument in getopt.getopt(sys.argv[1:], '', [strParameter[2:] + '=' for strParameter in sys.argv[1::2]])[0]:
+        if strOption == '--task':
+            task = strArgument
+        elif strOption == '--model':
+            model_path = strArgument
+        elif strOption == '--vn':
+            video_name = strArgument
+        elif strOption == '--ov':
+            output_video = strArgument
+        elif strOption == '--batchSize':
+            batch_size = int(strArgument)
+        elif strOption == '--memory':
+            memory_budget = float(strArgument) * 1024 * 1024
+        elif strOption == '--audio':
+            keep_audio = strArgument in ['True', 'true', 'TRUE', '1']
+        elif strOption == '--slowmo':
+            slowmo = int(strArgument)
+        elif strOption == '--gpuID':
+            gpuID = int(strArgument)
+
+    if task not in ['interp', 'denoise', 'denoising', 'sr', 'super-resolution']:
+        raise ValueError('Invalid [--task].\nOnly support: [interp, denoise/denoising, sr/super-resolution]')
+    if model_path == '':
+        raise ValueError('Missing [--model model_path].\nPlease provide the path of the toflow model.')
+    if video_name == '' or output_video == '':
+        raise ValueError('Missing [--vn video_name or --ov output_video].\nPlease provide the input and output videos.')
+    if slowmo < 2:
+        raise ValueError('Invalid [--slowmo].\nThe frame rate factor must be at least 2.')
+
+    if gpuID == None:
+        cuda_flag = False
+    else:
+        cuda_flag = True
+        torch.cuda.set_device(gpuID)
+
+    width, height, _ = probe_video(video_name)
+    net = load_model(model_path, height, width, task, cuda_flag=cuda_flag)
+
+    pre = datetime.datetime.now()
+    count = enhance_video(video_name, output_video, net, batch_size=batch_size, memory_budget=memory_budget,
+                          keep_audio=keep_audio, cuda_flag=cuda_flag, slowmo=slowmo)
+    seconds = (datetime.datetime.now() - pre).total_seconds()
+    print('Wrote %d frames to %s in %.2fs (%.2f fps).' % (count, output_video, seconds, count / seconds))
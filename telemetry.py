@@ -0,0 +1,144 @@
+import os
+import json
+import time
+import queue
+import threading
+import psutil
+import matplotlib.pyplot as plt
+
+plt.switch_backend('agg')
+
+
+class SystemSampler(object):
+    """
+    Samples the CPU and memory use of the machine and of this process every interval seconds
+    on a side thread. latest() returns the last sample without waiting.
+    """
+    def __init__(self, interval=5.0):
+        self.interval = interval
+        self.process = psutil.Process()
+        self.sample = {}
+        self.stopped = threading.Event()
+        # the first cpu_percent(None) only starts the measurement
+        psutil.cpu_percent(None)
+        self.process.cpu_percent(None)
+        self.thread = threading.Thread(target=self.run, name='system-sampler', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            memory = psutil.virtual_memory()
+            self.sample = {'cpu_percent': psutil.cpu_percent(None), 'process_cpu_percent': self.process.cpu_percent(None),
+                           'memory_percent': memory.percent, 'rss_mb': self.process.memory_info().rss / 1024 ** 2}
+
+    def latest(self):
+        return self.sample
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+class ImageWriter(object):
+    """write images with plt.imsave on a side thread, the training loop only hands over a host copy"""
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name='image-writer', daemon=True)
+        self.thread.start()
+
+    def write(self, name, image):
+        """:param image: [n_channels=3, h, w] tensor"""
+        self.queue.put((os.path.join(self.directory, name), image.detach().permute(1, 2, 0).cpu().clamp(0, 1).numpy()))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            plt.imsave(*item)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+class Telemetry(object):
+    """
+    Training telemetry. step() only adds to counters, and every interval seconds a side thread
+    appends a JSON line with the samples/s, step time, data wait and loss of the last interval
+    and the system sample of SystemSampler to path.
+    """
+    def __init__(self, path, interval=10.0, **fields):
+        """:param fields: added to every record, like the rank"""
+        self.path = path
+        self.interval = interval
+        self.fields = fields
+        self.system = SystemSampler(interval=min(interval, 5.0))
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.reset_window(self.start)
+        self.totals = {'steps': 0, 'samples': 0}
+        self.epoch = 0
+        self.fp = open(path, 'a')
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='telemetry', daemon=True)
+        self.thread.start()
+
+    def reset_window(self, now):
+        self.window = {'start': now, 'steps': 0, 'samples': 0, 'step_seconds': 0.0, 'wait_seconds': 0.0, 'loss': 0.0}
+
+    def step(self, samples, step_seconds, wait_seconds, loss):
+        """
+        :param samples: the number of samples, or crops, of the step
+        :param wait_seconds: the time spent waiting for the data of the step
+        """
+        with self.lock:
+            window = self.window
+            window['steps'] += 1
+            window['samples'] += samples
+            window['step_seconds'] += step_seconds
+            window['wait_seconds'] += wait_seconds
+            window['loss'] += loss
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def record(self, event='interval', **extra):
+        """:return: the record of the window since the last one, and start a new window"""
+        with self.lock:
+            now = time.perf_counter()
+            window = self.window
+            self.reset_window(now)
+            self.totals['steps'] += window['steps']
+            self.totals['samples'] += window['samples']
+            seconds = now - window['start']
+            steps = max(window['steps'], 1)
+            record = {'time': time.time(), 'event': event, 'elapsed_s': now - self.start, 'epoch': self.epoch,
+                      'steps': window['steps'], 'total_steps': self.totals['steps'], 'total_samples': self.totals['samples'],
+                      'samples_per_s': window['samples'] / seconds if seconds > 0 else 0.0,
+                      'step_ms': window['step_seconds'] / steps * 1000, 'data_wait_ms': window['wait_seconds'] / steps * 1000,
+                      'loss': window['loss'] / steps if window['steps'] else None}
+            record.update(self.system.latest())
+            record.update(self.fields)
+            record.update(extra)
+            self.fp.write(json.dumps(record) + '\n')
+            self.fp.flush()
+        return record
+
+    def latest(self):
+        """the last system sample, for progress messages"""
+        return self.system.latest()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.record()
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        self.record(event='end')
+        self.system.close()
+        self.fp.close()
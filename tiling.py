@@ -0,0 +1,119 @@
+import math
+import torch
+
+# Peak bytes per pixel of TOFlow.inference, calibrated on CPU in float32: the largest growth of the
+# peak RSS (ru_maxrss) over ten inference calls in a fresh process, after loading the model and a tiny
+# warmup call, at 224x224, 256x256, 384x640 and 544x544 with batch sizes 1 and 2, rounded up.
+# The repeated calls matter, tiled inference runs one after another and the peak of the first call
+# is about 15% lower. sr runs the same networks on 7 frames as denoise.
+bytes_per_pixel = {'interp': 2200, 'denoise': 6100, 'sr': 6100}
+task_aliases = {'denoising': 'denoise', 'super-resolution': 'sr'}
+
+
+def estimate_memory(task, height, width, batch_size=1):
+    """
+    :return: the estimated peak memory in bytes of TOFlow.inference on [batch_size, img_num, 3, height, width],
+             on top of the memory of the loaded model
+    """
+    task = task_aliases.get(task, task)
+    if task not in bytes_per_pixel:
+        raise NameError('Only support: [interp, denoise/denoising, sr/super-resolution]')
+    return batch_size * height * width * bytes_per_pixel[task]
+
+
+def tile_starts(size, tile, overlap):
+    """the start offsets of the tiles along one axis, the last tile is shifted inwards to end at size"""
+    if tile >= size:
+        return [0]
+    stride = tile - overlap
+    starts = list(range(0, size - tile, stride))
+    starts.append(size - tile)
+    return starts
+
+
+def blend_ramp(length, overlap, ramp_start, ramp_end):
+    """1D blending weights of a tile: a linear ramp over the overlap on every side shared with another tile"""
+    ramp = torch.ones(length)
+    overlap = min(overlap, length)
+    if overlap > 0:
+        rise = (torch.arange(overlap, dtype=torch.float32) + 0.5) / overlap
+        if ramp_start:
+            ramp[:overlap] = torch.min(ramp[:overlap], rise)
+        if ramp_end:
+            ramp[-overlap:] = torch.min(ramp[-overlap:], rise.flip(0))
+    return ramp
+
+
+class TiledTOFlow(object):
+    """
+    Run TOFlow.inference on overlapping tiles of high resolution frames.
+    Tiles are processed batch_tiles at a time and blended with linear ramps over the overlap,
+    so away from the seams the output matches the untiled network.
+    """
+    def __init__(self, net, tile_size=None, overlap=32, memory_budget=None, batch_tiles=1):
+        """
+        :param net: a TOFlow network
+        :param tile_size: (tile_height, tile_width) including the overlap. derived from memory_budget if None.
+        :param overlap: the number of pixels shared by neighbouring tiles
+        :param memory_budget: the memory in bytes that a call may use, for batch_tiles tiles of every frame
+                              window of the batch at the same time and the blended output. the tile size is
+                              derived again from the batch size and frame size of every call.
+        :param batch_tiles: the number of tiles per forward pass
+        """
+        if tile_size is None and memory_budget is None:
+            raise ValueError('Please provide either tile_size or memory_budget.')
+        self.net = net
+        self.overlap = overlap
+        self.batch_tiles = batch_tiles
+        self.memory_budget = memory_budget if tile_size is None else None
+        if tile_size is None:
+            tile_size = self.tile_size_for_budget(memory_budget)
+        elif min(tile_size) <= overlap:
+            raise ValueError('The tile %dx%d must be larger than the overlap of %d.' % (tile_size[0], tile_size[1], overlap))
+        self.tile_height, self.tile_width = tile_size
+
+    def tile_size_for_budget(self, memory_budget, batch_size=1):
+        """:param batch_size: the number of frame windows every tile is cut from in one call"""
+        # the largest square tile, in multiples of 32 so that SpyNet can down-sample it, that fits the budget.
+        pixels = memory_budget / estimate_memory(self.net.task, 1, 1, self.batch_tiles * batch_size)
+        side = int(math.sqrt(max(pixels, 0))) // 32 * 32
+        smallest = max(2 * self.overlap + 32, 64)
+        if side < smallest:
+            raise ValueError('A memory budget of %.0fMB is too small: the smallest tile of %dx%d with an overlap of %d '
+                             'and a batch of %d needs about %.0fMB.' %
+                             (memory_budget / 1024 ** 2, smallest, smallest, self.overlap, batch_size,
+                              estimate_memory(self.net.task, smallest, smallest, self.batch_tiles * batch_size) / 1024 ** 2))
+        return side, side
+
+    def __call__(self, frames):
+        """
+        :param frames: [batch_size, img_num, n_channels=3, h, w]
+        :return: Img: [batch_size, n_channels=3, h, w]
+        """
+        batch_size, height, width = frames.size(0), frames.size(3), frames.size(4)
+        tile_height, tile_width = self.tile_height, self.tile_width
+        if self.memory_budget is not None:
+            # the output and the blending weights of the whole frames are kept during the call
+            blend_bytes = (batch_size * 3 + 1) * height * width * frames.element_size()
+            tile_height, tile_width = self.tile_size_for_budget(self.memory_budget - blend_bytes, batch_size)
+        tile_height = min(tile_height, height)
+        tile_width = min(tile_width, width)
+        if tile_height == height and tile_width == width:
+            return self.net.inference(frames)
+
+        output = frames.new_zeros(batch_size, 3, height, width)
+        weight = frames.new_zeros(1, 1, height, width)
+        boxes = [(top, left) for top in tile_starts(height, tile_height, self.overlap)
+                 for left in tile_starts(width, tile_width, self.overlap)]
+
+        for start in range(0, len(boxes), self.batch_tiles):
+            batch_boxes = boxes[start:start + self.batch_tiles]
+            tiles = torch.cat([frames[:, :, :, top:top + tile_height, left:left + tile_width] for top, left in batch_boxes])
+            predicted = self.net.inference(tiles)
+            for k, (top, left) in enumerate(batch_boxes):
+                ramp_h = blend_ramp(tile_height, self.overlap, top > 0, top + tile_height < height)
+                ramp_w = blend_ramp(tile_width, self.overlap, left > 0, left + tile_width < width)
+                tile_weight = (ramp_h.view(-1, 1) * ramp_w.view(1, -1)).to(device=frames.device, dtype=frames.dtype)
+                output[:, :, top:top + tile_height, left:left + tile_width] += predicted[k * batch_size:(k + 1) * batch_size] * tile_weight
+                weight[:, :, top:top + tile_height, left:left + tile_width] += tile_weight
+        return output.div_(weight)
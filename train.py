@@ -1,13 +1,19 @@
 import os
 import datetime
+import time
 import torch
+import torch.distributed
+import torch.utils.data.distributed
 import matplotlib.pyplot as plt
 import multiprocessing
-import psutil
 import sys
 import getopt
 from Network import TOFlow
-from read_data import MemoryFriendlyLoader
+from profiling import profiler
+from read_data import MemoryFriendlyLoader, PackedLoader, RandomCrops, ResumableSampler, make_loader, split_batches, TimedLoader, \
+    CachedFlows, build_flow_cache, write_flow_cache_index, flow_cache_matches
+from checkpoint import AsyncCheckpointer, latest_checkpoint, rng_state, set_rng_state
+from telemetry import Telemetry, ImageWriter
 
 # ------------------------------
 # I don't know whether you have a GPU.
@@ -20,6 +26,23 @@ dataset_dir = ''
 edited_img_dir = ''
 pathlistfile = ''
 gpuID = None
+BATCH_SIZE = 1
+pack_dir = ''
+num_workers = 0
+prefetch = 2
+pin_memory = False
+profile_path = ''
+backend = 'gloo'
+threads = None
+activation_checkpointing = False
+crop_size = None
+crops_per_sample = 1
+checkpoint_every = 0
+resume_path = ''
+seed = 0
+telemetry_path = 'telemetry.jsonl'
+telemetry_interval = 10.0
+flow_cache_dir = ''
 
 if sys.argv[1] in ['-h', '--help']:
     print("""pytoflow version 1.0
@@ -30,7 +53,28 @@ options:
 --dataDir      the directory of the image dataset(Vimeo-90K)
 --ex_dataDir   the directory of the preprocessed image dataset, for example, the Vimeo-90K mixed by Gaussian noise.
 --pathlist     the text file records which are the images for train.
---gpuID        the No. of the GPU you want to use.
+--gpuID        the No. of the GPU you want to use. processes launched by torchrun use the following ones.
+--batchSize    the number of samples per training step. default: 1
+--packDir      the directory of the dataset packed by pack_data.py, instead of --dataDir/--ex_dataDir/--pathlist.
+--workers      the number of data loading processes. default: 0, loading in the training process.
+--prefetch     the number of batches every worker loads ahead. default: 2
+--pinMemory    stage the batches in pinned memory. default: False
+--profile      write a Chrome trace of the hot paths to this file, and a summary next to it.
+--backend      the torch.distributed backend when launched by torchrun, gloo or nccl. default: gloo
+--threads      the number of intra-op threads of every process. default: all, or OMP_NUM_THREADS
+--crop         train on random crops of this size, like 128x128 or 128, aligned across the frames and the ground truth.
+--cropsPerSample
+               the number of crops taken from every decoded sample, each one a training sample. default: 1
+--checkpointEvery
+               also checkpoint every this many steps, in the background. default: 0, only at the end of every epoch
+--resume       resume from this checkpoint, or from the latest one in ./checkpoints with latest, part way through an epoch too.
+--seed         the seed of the sample order of every epoch. default: 0
+--telemetry    append the samples/s, step time, data wait, loss and system use to this JSON lines file. default: telemetry.jsonl
+--telemetryInterval
+               the seconds between two telemetry records. default: 10
+--flowCache    freeze SpyNet and read its flows from this directory, estimating them into it first if they are missing or stale.
+               only warp and ResNet run in every step.
+--recompute    recompute the SpyNet and ResNet activations in backward to save memory for larger batches. default: False
 --help         get help.""")
     exit(0)
 
@@ -45,6 +89,40 @@ for strOption, strArgument in getopt.getopt(sys.argv[1:], '', [strParameter[2:]
         pathlistfile = strArgument
     elif strOption == '--gpuID':        # gpu id
         gpuID = int(strArgument)
+    elif strOption == '--batchSize':    # batch size
+        BATCH_SIZE = int(strArgument)
+    elif strOption == '--packDir':      # packed dataset
+        pack_dir = strArgument
+    elif strOption == '--workers':      # data loading processes
+        num_workers = int(strArgument)
+    elif strOption == '--prefetch':     # prefetched batches per worker
+        prefetch = int(strArgument)
+    elif strOption == '--pinMemory':    # pinned memory staging
+        pin_memory = strArgument in ['True', 'true', 'TRUE', '1']
+    elif strOption == '--profile':      # Chrome trace file
+        profile_path = strArgument
+    elif strOption == '--backend':      # distributed backend
+        backend = strArgument
+    elif strOption == '--threads':      # intra-op threads
+        threads = int(strArgument)
+    elif strOption == '--crop':         # random crop size
+        crop_size = tuple(int(x) for x in strArgument.split('x')) if 'x' in strArgument else (int(strArgument),) * 2
+    elif strOption == '--cropsPerSample':   # crops per decoded sample
+        crops_per_sample = int(strArgument)
+    elif strOption == '--checkpointEvery':  # steps between checkpoints
+        checkpoint_every = int(strArgument)
+    elif strOption == '--resume':       # checkpoint to resume from
+        resume_path = strArgument
+    elif strOption == '--seed':         # sample order
+        seed = int(strArgument)
+    elif strOption == '--telemetry':    # telemetry log
+        telemetry_path = strArgument
+    elif strOption == '--telemetryInterval':    # seconds between telemetry records
+        telemetry_interval = float(strArgument)
+    elif strOption == '--flowCache':    # cache of the frozen SpyNet flows
+        flow_cache_dir = strArgument
+    elif strOption == '--recompute':    # activation checkpointing
+        activation_checkpointing = strArgument in ['True', 'true', 'TRUE', '1']
 
 
 if task == '':
@@ -52,21 +130,40 @@ if task == '':
 elif task not in ['interp', 'denoise', 'denoising', 'sr', 'super-resolution']:
     raise ValueError('Invalid [--task].\nOnly support: [interp, denoise/denoising, sr/super-resolution]')
 
-if dataset_dir == '':
-    raise ValueError('Missing [--dataDir].\nPlease provide the directory of the dataset. (Vimeo-90K)')
-if task in ['denoise', 'denoising', 'sr', 'super-resolution'] and edited_img_dir == '':
-    raise ValueError('Missing [--ex_dataDir]. \
-                    \nPlease provide the directory of the edited image dataset \
-                    \nif you train on denoising or super resolution task. (Vimeo-90K)')
+if pack_dir == '':
+    if dataset_dir == '':
+        raise ValueError('Missing [--dataDir].\nPlease provide the directory of the dataset. (Vimeo-90K)')
+    if task in ['denoise', 'denoising', 'sr', 'super-resolution'] and edited_img_dir == '':
+        raise ValueError('Missing [--ex_dataDir]. \
+                        \nPlease provide the directory of the edited image dataset \
+                        \nif you train on denoising or super resolution task. (Vimeo-90K)')
 
-if pathlistfile == '':
-    raise ValueError('Missing [--pathlist].\nPlease provide the pathlist index file.')
+    if pathlistfile == '':
+        raise ValueError('Missing [--pathlist].\nPlease provide the pathlist index file.')
 
 if gpuID == None:
     cuda_flag = False
+    device = torch.device('cpu')
 else:
     cuda_flag = True
+    # the processes launched by torchrun on this machine take the following GPUs
+    gpuID += int(os.environ.get('LOCAL_RANK', 0))
     torch.cuda.set_device(gpuID)
+    device = torch.device('cuda', gpuID)
+if threads != None:
+    torch.set_num_threads(threads)
+
+# data parallel training when launched by torchrun, like
+# torchrun --nproc_per_node 4 train.py --task denoise ...
+# torchrun --nnodes 2 --node_rank 0 --master_addr host0 --nproc_per_node 16 train.py --task denoise ...
+world_size = int(os.environ.get('WORLD_SIZE', 1))
+distributed = world_size > 1
+if distributed:
+    torch.distributed.init_process_group(backend=backend)
+    rank = torch.distributed.get_rank()
+else:
+    rank = 0
+is_main = rank == 0
 # --------------------------------------------------------------
 # Hyper Parameters
 if task == 'interp':
@@ -75,22 +172,44 @@ elif task in ['denoise', 'denoising', 'sr', 'super-resolution']:
     LR = 1 * 1e-4
 EPOCH = 5
 WEIGHT_DECAY = 1e-4
-BATCH_SIZE = 1
 LR_strategy = []
 h = 256
 w = 448
 
-use_checkpoint = False
-checkpoint_path = './checkpoints/checkpoint_0epoch.ckpt'
+use_checkpoint = resume_path != ''
+checkpoint_dir = './checkpoints'
+checkpoint_path = latest_checkpoint(checkpoint_dir) if resume_path == 'latest' else resume_path
+if use_checkpoint and checkpoint_path == None:
+    raise ValueError('Invalid [--resume].\nThere is no checkpoint in %s.' % checkpoint_dir)
 work_place = '.'
 model_name = task
 Training_pic_path = 'Training_result.jpg'
 model_information_txt = model_name + '_information.txt'
 # --------------------------------------------------------------
 # prepare DataLoader
-Dataset = MemoryFriendlyLoader(origin_img_dir=dataset_dir, edited_img_dir=edited_img_dir, pathlistfile=pathlistfile, task=task)
-train_loader = torch.utils.data.DataLoader(dataset=Dataset, batch_size=BATCH_SIZE, shuffle=True, num_workers=0)
-sample_size = Dataset.count
+if pack_dir == '':
+    Dataset = MemoryFriendlyLoader(origin_img_dir=dataset_dir, edited_img_dir=edited_img_dir, pathlistfile=pathlistfile, task=task)
+else:
+    Dataset = PackedLoader(pack_dir, task=task)
+# the samples without flows and crops, for the flow cache
+Samples = Dataset
+if flow_cache_dir != '':
+    # the flows are estimated into the cache once the model is loaded, see below
+    Dataset = CachedFlows(Dataset, flow_cache_dir)
+if crop_size != None:
+    # every loaded batch holds BATCH_SIZE * crops_per_sample crops, trained on in steps of BATCH_SIZE crops
+    Dataset = RandomCrops(Dataset, crop_size, crops_per_sample=crops_per_sample)
+else:
+    crops_per_sample = 1
+# every process trains on its own shard of the pathlist, in an order that a checkpoint can resume
+sampler = ResumableSampler(Dataset, num_replicas=world_size, rank=rank, shuffle=True, seed=seed)
+# seeded again at every epoch, so that starting the DataLoader iterator leaves the global generator,
+# restored by --resume, untouched
+loader_generator = torch.Generator()
+train_loader = TimedLoader(make_loader(Dataset, batch_size=BATCH_SIZE, shuffle=True, num_workers=num_workers,
+                                       prefetch=prefetch, pin_memory=pin_memory, sampler=sampler,
+                                       generator=loader_generator), device=device)
+sample_size = sampler.num_samples * crops_per_sample
 # --------------------------------------------------------------
 # some functions
 def show_time(now):
@@ -112,7 +231,21 @@ def delta_time(datetime1, datetime2):
     return second
 
 
-def save_checkpoint(net, optimizer, epoch, losses, savepath):
+def gather_rng_state():
+    """:return: the random generator states of every process, by rank. every process must call it"""
+    if not distributed:
+        return [rng_state()]
+    states = [None] * world_size
+    torch.distributed.all_gather_object(states, rng_state())
+    return states
+
+
+def save_checkpoint(net, optimizer, epoch, losses, name, rng, progress=None):
+    """
+    Snapshot the training state and write it to checkpoint_dir/name in the background.
+    :param rng: the random generator states of every process, of gather_rng_state
+    :param progress: the progress in epoch, {'position', 'epoch_loss', 'epoch_steps'}. default: the start of epoch
+    """
     save_json = {
         'cuda_flag': net.cuda_flag,
         'h': net.height,
@@ -120,13 +253,18 @@ def save_checkpoint(net, optimizer, epoch, losses, savepath):
         'net_state_dict': net.state_dict(),
         'optimizer_state_dict': optimizer.state_dict(),
         'epoch': epoch,
-        'losses': losses
+        'losses': losses,
+        'step': global_step,
+        'seed': seed,
+        'progress': progress or {'position': 0, 'epoch_loss': 0.0, 'epoch_steps': 0},
+        'rng': rng
     }
-    torch.save(save_json, savepath)
+    checkpointer.save(save_json, name)
 
 
 def load_checkpoint(net, optimizer, checkpoint_path):
-    checkpoint = torch.load(checkpoint_path)
+    # the random generator states are not plain tensors
+    checkpoint = torch.load(checkpoint_path, map_location=device, weights_only=False)
 
     net.cuda_flag = checkpoint['cuda_flag']
     net.height = checkpoint['h']
@@ -136,82 +274,206 @@ def load_checkpoint(net, optimizer, checkpoint_path):
     start_epoch = checkpoint['epoch']
     losses = checkpoint['losses']
 
-    return net, optimizer, start_epoch, losses
+    return net, optimizer, start_epoch, losses, checkpoint
 
 
 # --------------------------------------------------------------
-toflow = TOFlow(h, w, task=task, cuda_flag=cuda_flag).cuda()
+toflow = TOFlow(h, w, task=task, cuda_flag=cuda_flag).to(device)
+toflow.set_checkpointing(activation_checkpointing)
 
 optimizer = torch.optim.Adam(toflow.parameters(), lr=LR, weight_decay=WEIGHT_DECAY)
 loss_func = torch.nn.L1Loss()
 
 # Training
+if profile_path:
+    profiler.enable()
+
 prev_time = datetime.datetime.now()  # current time
-print('%s  Start training...' % show_time(prev_time))
+if is_main:
+    print('%s  Start training...' % show_time(prev_time))
 plotx = []
 ploty = []
 start_epoch = 0
 check_loss = 1
+global_step = 0
+progress = {'position': 0, 'epoch_loss': 0.0, 'epoch_steps': 0}
+# only the first process writes checkpoints and visualizations
+checkpointer = AsyncCheckpointer(checkpoint_dir) if is_main else None
+image_writer = ImageWriter('./visualization') if is_main else None
+visualize_codes = set(visualize_pathlist)
+if distributed:
+    telemetry_path = '%s_rank%d%s' % (os.path.splitext(telemetry_path)[0], rank, os.path.splitext(telemetry_path)[1])
+telemetry = Telemetry(telemetry_path, interval=telemetry_interval, rank=rank)
 
 if use_checkpoint:
-    toflow, optimizer, start_epoch, ploty = load_checkpoint(toflow, optimizer, checkpoint_path)
+    toflow, optimizer, start_epoch, ploty, checkpoint = load_checkpoint(toflow, optimizer, checkpoint_path)
     plotx = list(range(len(ploty)))
-    check_loss = min(ploty)
+    check_loss = min(ploty) if ploty else check_loss
+    if checkpoint.get('seed', seed) != seed:
+        raise ValueError('%s was trained with --seed %d, resume it with the same seed.' % (checkpoint_path, checkpoint['seed']))
+    global_step = checkpoint.get('step', 0)
+    progress = checkpoint.get('progress', progress)
+    # a list by rank, or the state of the only process in older checkpoints
+    rng = checkpoint.get('rng', [])
+    rng = [rng] if isinstance(rng, dict) else rng
+    if rank < len(rng):
+        set_rng_state(rng[rank])
+    if progress['position'] >= sampler.num_samples:
+        # taken on the last step of its epoch, finish that epoch and start the next one
+        if progress['epoch_steps'] > 0 and len(ploty) == start_epoch:
+            plotx.append(start_epoch + 1)
+            ploty.append(progress['epoch_loss'] / progress['epoch_steps'])
+        if start_epoch in LR_strategy:
+            optimizer.param_groups[0]['lr'] /= 10
+        start_epoch += 1
+        progress = {'position': 0, 'epoch_loss': 0.0, 'epoch_steps': 0}
+    if is_main:
+        print('%s  Resuming %s from epoch %d, %d samples in.' %
+              (show_time(datetime.datetime.now()), checkpoint_path, start_epoch + 1, progress['position']))
+
+if flow_cache_dir != '':
+    # SpyNet is frozen and its flows are read from the cache
+    for param in toflow.SpyNet.parameters():
+        param.requires_grad = False
+    stale = torch.tensor([0 if flow_cache_matches(flow_cache_dir, toflow, Samples) else 1], device=device)
+    if distributed:
+        # every process has checked the cache before any of them starts rebuilding it
+        torch.distributed.all_reduce(stale, op=torch.distributed.ReduceOp.MAX)
+    if stale.item():
+        if is_main:
+            print('%s  Estimating the flows of %d samples into %s...' % (show_time(datetime.datetime.now()), Samples.count, flow_cache_dir))
+        # every process estimates its own part of the samples, so that the barriers below only wait for
+        # the slowest part, not for the whole pathlist, and stay well within the timeout of the process group
+        index = build_flow_cache(toflow, Samples, flow_cache_dir, batch_size=BATCH_SIZE, rank=rank, world_size=world_size)
+        if distributed:
+            torch.distributed.barrier()
+            if is_main:
+                write_flow_cache_index(flow_cache_dir, index)
+            torch.distributed.barrier()
+
+if distributed:
+    # all-reduces the gradients during backward. the ResNet layers of the other tasks are never used,
+    # and neither are the coarse SpyNet levels on small frames.
+    model = torch.nn.parallel.DistributedDataParallel(toflow, device_ids=[gpuID] if cuda_flag else None,
+                                                      find_unused_parameters=True)
+else:
+    model = toflow
 
+checkpoint_due = False
 for epoch in range(start_epoch, EPOCH):
-    losses = 0
-    count = 0
-    for step, (x, y, path_code) in enumerate(train_loader):
-        x = x.cuda()
-        reference = y.cuda()
-
-        prediction = toflow(x)
-        prediction = prediction.cuda()
-        loss = loss_func(prediction, reference)
-
-        # losses += loss                # the reason why oom happened
-        losses += loss.item()
-        optimizer.zero_grad()
-
-        loss.backward()
-        optimizer.step()
-
+    if epoch == start_epoch:
+        # skip the samples of the resumed epoch trained on before the checkpoint
+        sampler.set_position(epoch, progress['position'])
+        losses = progress['epoch_loss']
+        epoch_steps = progress['epoch_steps']
+    else:
+        sampler.set_epoch(epoch)
+        losses = 0
+        epoch_steps = 0
+    loader_generator.manual_seed(seed + epoch)
+    count = sampler.start * crops_per_sample
+    skipped = count
+    telemetry.set_epoch(epoch + 1)
+    waited = 0.0
+    for step, batch in enumerate(split_batches(train_loader, BATCH_SIZE)):
+        x, y, path_code = batch[:3]
+        flows = batch[3] if flow_cache_dir != '' else None
+        reference = y
+        step_start = time.perf_counter()
+
+        with profiler.span('train.step'):
+            prediction = model(x, flows=flows)
+            loss = loss_func(prediction, reference)
+
+            # losses += loss                # the reason why oom happened
+            step_loss = loss.item()
+            losses += step_loss
+            optimizer.zero_grad()
+
+            with profiler.span('train.backward'):
+                loss.backward()
+            optimizer.step()
+
+        # the steps of the crops of a loaded batch after the first one do not wait
+        telemetry.step(len(x), time.perf_counter() - step_start, train_loader.total_wait - waited, step_loss)
+        waited = train_loader.total_wait
         count += len(x)
-        if count / 1000 == count // 1000:
-            print('%s  Processed %0.2f%% triples.\tMemory used %0.2f%%.\tCpu used %0.2f%%.' %
-                  (show_time(datetime.datetime.now()), count / sample_size * 100, psutil.virtual_memory().percent,
-                   psutil.cpu_percent(1)))
-
-        if not os.path.exists('./visualization/'):
-            os.mkdir('./visualization/')
-        if path_code[0] in visualize_pathlist:
-            plt.imsave('./visualization/%d-%s.png' % ((epoch + 1), path_code[0].replace('/','-')),
-                       prediction[0, :, :, :].permute(1, 2, 0).cpu().detach().numpy())
-
-    print('\n%s  epoch %d: Average_loss=%f\n' % (show_time(datetime.datetime.now()), epoch + 1, losses / (step + 1)))
+        epoch_steps += 1
+        global_step += 1
+        if checkpoint_every > 0 and global_step % checkpoint_every == 0:
+            checkpoint_due = True
+        # checkpoint once the crops of the last loaded batch are all trained on
+        if checkpoint_due and count - skipped == train_loader.fetched:
+            checkpoint_due = False
+            rng = gather_rng_state()
+            if is_main:
+                save_checkpoint(toflow, optimizer, epoch, ploty, 'checkpoint_%dstep.ckpt' % global_step, rng,
+                                progress={'position': count // crops_per_sample, 'epoch_loss': losses, 'epoch_steps': epoch_steps})
+        if is_main and count // 1000 > (count - len(x)) // 1000:
+            system = telemetry.latest()
+            print('%s  Processed %0.2f%% triples.\tMemory used %0.2f%%.\tCpu used %0.2f%%.\tData wait %0.1fms/step.' %
+                  (show_time(datetime.datetime.now()), count / sample_size * 100, system.get('memory_percent', 0.0),
+                   system.get('cpu_percent', 0.0), train_loader.total_wait / max(train_loader.steps, 1) * 1000))
+
+        if image_writer != None:
+            for i, code in enumerate(path_code):
+                if code in visualize_codes:
+                    # the PNG is encoded and written by the image writer thread
+                    with profiler.span('train.write'):
+                        image_writer.write('%d-%s.png' % ((epoch + 1), code.replace('/', '-')), prediction[i])
+
+    if distributed:
+        # the average loss over the steps of every process
+        totals = torch.tensor([losses, epoch_steps], dtype=torch.float64, device=device)
+        torch.distributed.all_reduce(totals)
+        losses, epoch_steps = totals[0].item(), int(totals[1].item())
+    average_loss = losses / max(epoch_steps, 1)
+    telemetry.record(event='epoch', average_loss=average_loss)
+    if is_main:
+        print('\n%s  epoch %d: Average_loss=%f\tData wait %0.1fms/step (%0.1fs in total)\n' %
+              (show_time(datetime.datetime.now()), epoch + 1, average_loss,
+               train_loader.total_wait / max(train_loader.steps, 1) * 1000, train_loader.total_wait))
 
     # learning rate strategy
     if epoch in LR_strategy:
         optimizer.param_groups[0]['lr'] /= 10
 
     plotx.append(epoch + 1)
-    ploty.append(losses / (step + 1))
+    ploty.append(average_loss)
+    # only the first process writes, the weights of every process are the same
+    rng = gather_rng_state()
+    if not is_main:
+        continue
     if epoch // 1 == epoch / 1:
         plt.plot(plotx, ploty)
         plt.savefig(Training_pic_path)
 
     # checkpoint and then prepare for the next epoch
-    if not os.path.exists('./checkpoints'):
-        os.mkdir('./checkpoints')
-    save_checkpoint(toflow, optimizer, epoch + 1, ploty, './checkpoints/checkpoint_%depoch.ckpt' % (epoch + 1))
+    save_checkpoint(toflow, optimizer, epoch + 1, ploty, 'checkpoint_%depoch.ckpt' % (epoch + 1), rng)
 
-    if check_loss > losses / (step + 1):
+    if check_loss > average_loss:
         print('\n%s Saving the best model temporarily...' % show_time(datetime.datetime.now()))
         if not os.path.exists(os.path.join(work_place, 'toflow_models')):
             os.mkdir(os.path.join(work_place, 'toflow_models'))
         torch.save(toflow.state_dict(), os.path.join(work_place, 'toflow_models', model_name + '_best_params.pkl'))
         print('Saved.\n')
-        check_point = losses / (step + 1)
+        check_point = average_loss
+
+if checkpointer != None:
+    # wait for the last checkpoints and visualizations to be written
+    checkpointer.close()
+    image_writer.close()
+telemetry.close()
+
+if profile_path:
+    if distributed:
+        profile_path = '%s_rank%d%s' % (os.path.splitext(profile_path)[0], rank, os.path.splitext(profile_path)[1])
+    profiler.write_report(profile_path)
+
+if distributed:
+    torch.distributed.destroy_process_group()
+if not is_main:
+    sys.exit(0)
 
 plt.plot(plotx, ploty)
 plt.savefig(Training_pic_path)
@@ -3,10 +3,11 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import torch.utils.serialization
 import math
 import PIL
-from Network import TOFlow
+from model_package import load_model
+from tiling import TiledTOFlow
+from profiling import profiler
 import matplotlib.pyplot as plt
 import sys
 import getopt
@@ -21,6 +22,13 @@ frameFirstName = None
 frameSecondName = None
 frameOutName = os.path.join(workplace, 'out.png')
 gpuID = None
+memory_budget = None    # MB, tiled inference if provided
+tile_size = None
+overlap = 32
+batch_tiles = 1
+profile_path = ''
+precision = None      # fp32 or bf16, the precision of the model package by default
+model_path = None     # toflow_models/<model_name>.pkl by default
 
 for strOption, strArgument in getopt.getopt(sys.argv[1:], '', [strParameter[2:] + '=' for strParameter in sys.argv[1::2]])[0]:
     if strOption == '--f1':          # first frame
@@ -31,6 +39,20 @@ for strOption, strArgument in getopt.getopt(sys.argv[1:], '', [strParameter[2:]
         frameOutName = strArgument
     elif strOption == '--gpuID':
         gpuID = int(strArgument)
+    elif strOption == '--memory':    # memory budget of tiled inference (MB)
+        memory_budget = float(strArgument)
+    elif strOption == '--tile':      # tile size of tiled inference
+        tile_size = int(strArgument)
+    elif strOption == '--overlap':   # overlap between tiles
+        overlap = int(strArgument)
+    elif strOption == '--batchTiles':
+        batch_tiles = int(strArgument)
+    elif strOption == '--profile':   # Chrome trace file
+        profile_path = strArgument
+    elif strOption == '--precision': # fp32 or bf16
+        precision = strArgument
+    elif strOption == '--model':     # float or int8 model
+        model_path = strArgument
 
 if frameFirstName == None or frameSecondName == None:
     raise ('Missing [-f1 frameFirstName or -f2 frameSecondName].\nPlease enter the name of two frames.')
@@ -40,10 +62,10 @@ if gpuID == None:
 else:
     CUDA = True
 # ------------------------------
-# 数据集中的图片长宽都弄成32的倍数了所以这里可以不用这个函数
 # 暂时只用于处理batch_size = 1的triple
 def Estimate(net, tensorFirst=None, tensorSecond=None, Firstfilename='', Secondfilename='', cuda_flag=False):
     """
+    :param net: TOFlow.inference or a TiledTOFlow, called on [1, img_num=2, 3, h, w] of any h and w
     :param tensorFirst: 弄成FloatTensor格式的frameFirst
     :param tensorSecond: 弄成FloatTensor格式的frameSecond
     :return:
@@ -52,77 +74,56 @@ def Estimate(net, tensorFirst=None, tensorSecond=None, Firstfilename='', Secondf
         tensorFirst = torch.FloatTensor(np.array(PIL.Image.open(Firstfilename).convert("RGB")).transpose(2, 0, 1).astype(np.float32) * (1.0 / 255.0))
         tensorSecond = torch.FloatTensor(np.array(PIL.Image.open(Secondfilename).convert("RGB")).transpose(2, 0, 1).astype(np.float32) * (1.0 / 255.0))
 
-    tensorOutput = torch.FloatTensor()
-
     # check whether the two frames have the same shape
     assert (tensorFirst.size(1) == tensorSecond.size(1))
     assert (tensorFirst.size(2) == tensorSecond.size(2))
 
-    intWidth = tensorFirst.size(2)
-    intHeight = tensorFirst.size(1)
-
-    # assert(intWidth == 448) # remember that there is no guarantee for correctness, comment this line out if you acknowledge this and want to continue
-    # assert(intHeight == 256) # remember that there is no guarantee for correctness, comment this line out if you acknowledge this and want to continue
-
     if cuda_flag == True:
         tensorFirst = tensorFirst.cuda()
         tensorSecond = tensorSecond.cuda()
-        tensorOutput = tensorOutput.cuda()
     # end
 
-    if True:
-        tensorPreprocessedFirst = tensorFirst.view(1, 3, intHeight, intWidth)
-        tensorPreprocessedSecond = tensorSecond.view(1, 3, intHeight, intWidth)
-
-        intPreprocessedWidth = int(math.floor(math.ceil(intWidth / 32.0) * 32.0))  # 宽度弄成32的倍数，便于上下采样
-        intPreprocessedHeight = int(math.floor(math.ceil(intHeight / 32.0) * 32.0))  # 长度弄成32的倍数，便于上下采样
+    # TOFlow pads the frames to a multiple of 32 and crops its output, no resizing is needed.
+    tensorOutput = net(torch.stack([tensorFirst, tensorSecond]).unsqueeze(0))
+    tensorOutput = tensorOutput[0, :, :, :].permute(1, 2, 0)
 
-        tensorPreprocessedFirst = torch.nn.functional.interpolate(input=tensorPreprocessedFirst, size=(
-            intPreprocessedHeight, intPreprocessedWidth), mode='bilinear', align_corners=False)
-        tensorPreprocessedSecond = torch.nn.functional.interpolate(input=tensorPreprocessedSecond, size=(
-            intPreprocessedHeight, intPreprocessedWidth), mode='bilinear', align_corners=False)
-
-
-        tensorFlow = torch.nn.functional.interpolate(
-            input=net(tensorPreprocessedFirst, tensorPreprocessedSecond),
-            size=(intHeight, intWidth), mode='bilinear', align_corners=False)
-
-        tensorOutput.resize_(3, intHeight, intWidth).copy_(tensorFlow[0, :, :, :])
-        tensorOutput = tensorOutput.permute(1, 2, 0)
-    # end
-
-    if True:
-        tensorFirst = tensorFirst.cpu()
-        tensorSecond = tensorSecond.cpu()
-        tensorOutput = tensorOutput.cpu()
-    # end
-    return tensorOutput.detach().numpy()
+    return tensorOutput.cpu().detach().numpy()
 
 # ------------------------------
 if __name__ == '__main__':
     if CUDA:
         torch.cuda.set_device(gpuID)
+    if profile_path:
+        profiler.enable()
     temp_img = np.array(plt.imread(frameFirstName))
     height = temp_img.shape[0]
     width = temp_img.shape[1]
 
-    intPreprocessedWidth = int(math.floor(math.ceil(width / 32.0) * 32.0))  # 宽度弄成32的倍数，便于上下采样
-    intPreprocessedHeight = int(math.floor(math.ceil(height / 32.0) * 32.0))  # 长度弄成32的倍数，便于上下采样
-
     print('Loading TOFlow Net... ', end='')
-    net = TOFlow(intPreprocessedHeight, intPreprocessedWidth, cuda_flag=CUDA)
-    net.load_state_dict(torch.load(os.path.join(workplace, 'toflow_models', model_name + '.pkl')))
-    if CUDA:
-        net.eval().cuda()
-    else:
-        net.eval()
+    if model_path == None:
+        model_path = os.path.join(workplace, 'toflow_models', model_name + '.pkl')
+    # saved by train.py, or a model package
+    net = load_model(model_path, height, width, model_name, cuda_flag=CUDA, precision=precision)
 
     print('Done.')
 
+    if memory_budget != None or tile_size != None:
+        engine = TiledTOFlow(net,
+                             tile_size=None if tile_size == None else (tile_size, tile_size),
+                             overlap=overlap,
+                             memory_budget=None if memory_budget == None else memory_budget * 1024 * 1024,
+                             batch_tiles=batch_tiles)
+    else:
+        engine = net.inference
+
     # ------------------------------
     # generate(net=net, model_name=model_name, f1name=os.path.join(test_pic_dir, 'im1.png'),
     #         f2name=os.path.join(test_pic_dir, 'im3.png'), fname=outputname)
     print('Processing...')
-    predict = Estimate(net, Firstfilename=frameFirstName, Secondfilename=frameSecondName, cuda_flag=CUDA)
-    plt.imsave(frameOutName, predict)
+    with profiler.span('run.estimate'):
+        predict = Estimate(engine, Firstfilename=frameFirstName, Secondfilename=frameSecondName, cuda_flag=CUDA)
+    with profiler.span('run.write'):
+        plt.imsave(frameOutName, predict)
     print('%s Saved.' % frameOutName)
+    if profile_path:
+        profiler.write_report(profile_path)
@@ -0,0 +1,166 @@
+import os
+import sys
+import json
+import time
+import getopt
+import numpy as np
+import torch
+import matplotlib.pyplot as plt
+from Network import precisions
+from model_package import load_model
+from metrics import MetricLog, quantize, psnr
+from read_data import get_process_index, read_sequence, read_ground_truth
+
+plt.switch_backend('agg')
+
+
+def validate(net, input_dir, codes, task, precision, gt_dir='', batch_size=1):
+    """
+    Run every sequence of codes through net in float32 and in precision.
+    :return: a report with the quality of both precisions against the ground truth (if gt_dir is given),
+             the PSNR of the reduced precision output against the float32 one, and the speed of both
+    """
+    process_index, str_format = get_process_index(task)
+    logs = {'fp32': MetricLog(), precision: MetricLog()} if gt_dir else {}
+    seconds = {'fp32': 0.0, precision: 0.0}
+    agreement = []
+    max_abs = 0.0
+    for start in range(0, len(codes), batch_size):
+        batch_codes = codes[start:start + batch_size]
+        frames = torch.from_numpy(np.array([read_sequence(input_dir, code, process_index, str_format) for code in batch_codes]))
+        if net.cuda_flag:
+            frames = frames.cuda()
+        if gt_dir:
+            # read once for both precisions, outside the timed forward passes
+            ground_truth = torch.from_numpy(np.array([read_ground_truth(gt_dir, code, task) for code in batch_codes]))
+        outputs = {}
+        for mode in ['fp32', precision]:
+            net.set_precision(mode)
+            stage_start = time.perf_counter()
+            outputs[mode] = net.inference(frames)
+            seconds[mode] += time.perf_counter() - stage_start
+            if gt_dir:
+                logs[mode].update(batch_codes, outputs[mode], ground_truth)
+        agreement += psnr(quantize(outputs[precision]), quantize(outputs['fp32'])).tolist()
+        max_abs = max(max_abs, (outputs[precision] - outputs['fp32']).abs().max().item())
+        print('%d/%d sequences.' % (start + len(batch_codes), len(codes)))
+    net.set_precision('fp32')
+
+    report = {'precision': precision, 'count': len(codes),
+              'psnr_vs_fp32': {'mean': float(np.mean(agreement)), 'min': float(np.min(agreement))},
+              'max_abs_vs_fp32': max_abs,
+              'seconds_per_sequence': dict((mode, seconds[mode] / len(codes)) for mode in seconds)}
+    if gt_dir:
+        report['fp32'] = logs['fp32'].summary()
+        report[precision] = logs[precision].summary()
+        report['psnr_delta'] = report[precision]['psnr'] - report['fp32']['psnr']
+        report['ssim_delta'] = report[precision]['ssim'] - report['fp32']['ssim']
+    return report
+
+
+if __name__ == '__main__':
+    task = ''
+    dataset_dir = ''
+    pathlistfile = ''
+    model_path = ''
+    gt_dir = ''
+    gpuID = None
+    batch_size = 1
+    precision = 'bf16'
+    max_drop = None
+    min_psnr = None
+    out_file = ''
+
+    if len(sys.argv) < 2 or sys.argv[1] in ['-h', '--help']:
+        print("""pytoflow version 1.1
+usage: python3 validate_precision.py [[option] [value]]...
+options:
+--task         the task of the model, like interp, denoising, super-resolution
+               valid values:[interp, denoise, denoising, sr, super-resolution]
+--dataDir      the directory of the input image dataset(Vimeo-90K, Vimeo-90K with noise, blurred Vimeo-90K)
+--pathlist     the text file records which are the images to validate on.
+--model        the path of the model used.
+--gtDir        the directory of the ground truth (Vimeo-90K). the PSNR/SSIM deltas are reported if provided.
+--precision    the reduced precision to validate. default: bf16
+--maxDrop      with --gtDir, exits with 1 if the precision loses more PSNR (dB) than this against the ground truth.
+               default: 0.1
+--minPsnr      without --gtDir, exits with 1 if the mean PSNR (dB) of the precision against fp32 is below this.
+               default: 40
+--batchSize    the number of sequences per forward pass. default: 1
+--out          write the report to this JSON file.
+--gpuID        the No. of the GPU you want to use. default: no gpu.
+-h, --help     get help.""")
+        exit(0)
+
+    for strOption, strArgument in getopt.getopt(sys.argv[1:], '', [strParameter[2:] + '=' for strParameter in sys.argv[1::2]])[0]:
+        if strOption == '--task':
+            task = strArgument
+        elif strOption == '--dataDir':
+            dataset_dir = strArgument
+        elif strOption == '--pathlist':
+            pathlistfile = strArgument
+        elif strOption == '--model':
+            model_path = strArgument
+        elif strOption == '--gtDir':
+            gt_dir = strArgument
+        elif strOption == '--precision':
+            precision = strArgument
+        elif strOption == '--maxDrop':
+            max_drop = float(strArgument)
+        elif strOption == '--minPsnr':
+            min_psnr = float(strArgument)
+        elif strOption == '--batchSize':
+            batch_size = int(strArgument)
+        elif strOption == '--out':
+            out_file = strArgument
+        elif strOption == '--gpuID':
+            gpuID = int(strArgument)
+
+    if task not in ['interp', 'denoise', 'denoising', 'sr', 'super-resolution']:
+        raise ValueError('Invalid [--task].\nOnly support: [interp, denoise/denoising, sr/super-resolution]')
+    if dataset_dir == '' or pathlistfile == '':
+        raise ValueError('Missing [--dataDir or --pathlist].\nPlease provide the sequences to validate on.')
+    if model_path == '':
+        raise ValueError('Missing [--model model_path].\nPlease provide the path of the toflow model.')
+    if precision not in precisions or precision == 'fp32':
+        raise ValueError('Invalid [--precision].\nOnly support: [%s]' % ', '.join(precisions[1:]))
+    if gt_dir == '' and max_drop != None:
+        raise ValueError('[--maxDrop] is measured against the ground truth, provide [--gtDir] or use [--minPsnr].')
+    if gt_dir != '' and min_psnr != None:
+        raise ValueError('[--minPsnr] is only checked without [--gtDir], use [--maxDrop].')
+    max_drop = 0.1 if max_drop == None else max_drop
+    min_psnr = 40.0 if min_psnr == None else min_psnr
+
+    if gpuID == None:
+        cuda_flag = False
+    else:
+        cuda_flag = True
+        torch.cuda.set_device(gpuID)
+
+    with open(pathlistfile) as fp:
+        codes = fp.read().splitlines()
+    height, width = read_sequence(dataset_dir, codes[0], *get_process_index(task)).shape[2:]
+    net = load_model(model_path, height, width, task, cuda_flag=cuda_flag)
+
+    report = validate(net, dataset_dir, codes, task, precision, gt_dir=gt_dir, batch_size=batch_size)
+    print('%s against fp32: mean PSNR %.2fdB, min PSNR %.2fdB, max abs %.4f' %
+          (precision, report['psnr_vs_fp32']['mean'], report['psnr_vs_fp32']['min'], report['max_abs_vs_fp32']))
+    print('Seconds per sequence: fp32 %.3fs, %s %.3fs' %
+          (report['seconds_per_sequence']['fp32'], precision, report['seconds_per_sequence'][precision]))
+    if gt_dir:
+        print('Against the ground truth: fp32 PSNR %.3f SSIM %.4f, %s PSNR %.3f SSIM %.4f, delta %+.3fdB' %
+              (report['fp32']['psnr'], report['fp32']['ssim'], precision, report[precision]['psnr'],
+               report[precision]['ssim'], report['psnr_delta']))
+    if out_file:
+        with open(out_file, 'w') as fp:
+            json.dump(report, fp, indent=2)
+        print('Report saved to %s.' % out_file)
+
+    if gt_dir:
+        passed = report['psnr_delta'] >= -max_drop
+    else:
+        passed = report['psnr_vs_fp32']['mean'] >= min_psnr
+    if not passed:
+        print('%s is not accurate enough for this model, keep fp32.' % precision)
+        sys.exit(1)
+    print('%s is safe to enable with --precision %s.' % (precision, precision))